@@ -0,0 +1,166 @@
+import time
+import core
+import perf
+import tetromino
+
+
+# Terminal output without urwid. A frame is drawn into a back buffer of
+# (attr, char) cells, flush() compares it with the front buffer, the cells
+# the terminal is known to show, and writes only the cells that changed.
+
+COLORS = {None: "0", "I": "96", "J": "94", "L": "33", "O": "93", "S": "92", "T": "35", "Z": "91", "ghost": "90"}
+SQUARE = "\N{WHITE SQUARE CONTAINING BLACK SMALL SQUARE}"
+BLANK = (None, " ")
+
+
+class AnsiScreen:
+    def __init__(self, write, width, height, x=0, y=0):
+        self.write = write
+        self.width = width
+        self.height = height
+        # terminal position of the top left cell
+        self.x = x
+        self.y = y
+        self.blank_row = [BLANK] * width
+        self.back = [self.blank_row[:] for _ in range(height)]
+        self.invalidate()
+        self.bytes_written = 0
+        self.frame_bytes = perf.RollingStat()
+        self.flush_time = perf.RollingStat()
+
+    def invalidate(self):
+        # the terminal was drawn over, the next flush repaints every cell
+        self.front = [[None] * self.width for _ in range(self.height)]
+
+    def clear(self):
+        for row in self.back:
+            row[:] = self.blank_row
+
+    def put(self, x, y, attr, char):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.back[y][x] = (attr, char)
+
+    def text(self, x, y, s, attr=None):
+        for i, c in enumerate(s):
+            self.put(x + i, y, attr, c)
+
+    def flush(self):
+        # bytes written, 0 when the frame did not change
+        start = time.perf_counter()
+        out = []
+        attr = False # unknown, the first cell always sets it
+        cx = cy = -1
+        for j, back in enumerate(self.back):
+            front = self.front[j]
+            if back == front:
+                continue
+            for i, cell in enumerate(back):
+                if cell == front[i]:
+                    continue
+                if cy != j or cx != i:
+                    # a short run of unchanged cells in the current color is
+                    # cheaper to write again than to jump over
+                    if cy == j and i - cx <= 2 and all(front[k][0] == attr for k in range(cx, i)):
+                        out.extend(front[k][1] for k in range(cx, i))
+                    else:
+                        out.append("\x1b[{};{}H".format(self.y + j + 1, self.x + i + 1))
+                if cell[0] != attr:
+                    attr = cell[0]
+                    out.append("\x1b[" + COLORS[attr] + "m")
+                out.append(cell[1])
+                cx, cy = i + 1, j
+            self.front[j] = back[:]
+
+        n = 0
+        if out:
+            if attr is not None:
+                out.append("\x1b[0m")
+            data = "".join(out)
+            n = len(data.encode("utf-8"))
+            self.write(data)
+            self.bytes_written += n
+            self.frame_bytes.add(n)
+            self.flush_time.add(time.perf_counter() - start)
+        return n
+
+    def stats(self):
+        return {"bytes_written": self.bytes_written,
+                "frame_bytes": self.frame_bytes.summary(),
+                "flush_time": self.flush_time.summary()}
+
+
+class Viewport:
+    # the part of the board on screen, for boards larger than the terminal
+    def __init__(self, game, max_width=None, max_height=None):
+        self.width = game.board_width if max_width is None else min(max_width, game.board_width)
+        self.height = game.board_height if max_height is None else min(max_height, game.board_height)
+        self.left = 0
+        self.top = 0
+
+    def follow(self, game):
+        # scroll to keep the piece in view, returns the top left board cell
+        if game.piece is not None:
+            self.left = scroll(self.left, game.x, game.piece.width(), self.width, game.board_width)
+            self.top = scroll(self.top, game.y, game.piece.height(), self.height, game.board_height)
+        return self.left, self.top
+
+
+def scroll(start, pos, size, view, total):
+    # start of a window of view cells over total cells. It only moves when
+    # pos .. pos + size comes near an edge, then centers on it, so the diff
+    # renderer does not repaint the board for every row the piece falls.
+    margin = view // 4
+    if pos < start + margin or pos + size > start + view - margin:
+        start = pos + size // 2 - view // 2
+    return max(0, min(start, total - view))
+
+
+def draw_game(screen, game, side_extra=(), view=None):
+    # the picture of PlayGameState.render: the board in a box, the next piece,
+    # level, lines and score to the right, then side_extra lines. Only the
+    # rows and columns of view are drawn, by default the whole board.
+    if view is None:
+        view = Viewport(game)
+    left, top = view.follow(game)
+    w, h = view.width, view.height
+    screen.clear()
+    put = screen.put
+
+    screen.text(0, 0, "┌" + "─" * w + "┐")
+    for n in range(h):
+        row = game.board.row_colors(top + n)
+        put(0, n + 1, None, "│")
+        for i in range(w):
+            c = row[left + i]
+            if tetromino.is_block(c):
+                put(i + 1, n + 1, c, SQUARE)
+            else:
+                put(i + 1, n + 1, "ghost", "|")
+        put(w + 1, n + 1, None, "│")
+    screen.text(0, h + 1, "└" + "─" * w + "┘")
+
+    if game.gamestate is not core.GameCore.GAMEOVER:
+        gx, gy = game.get_ghost_coords()
+        for attr, x, y in (("ghost", gx, gy), (game.piece.name, game.x, game.y)):
+            for i, j in game.piece.cells:
+                i, j = x + i - left, y + j - top
+                if 0 <= i < w and 0 <= j < h:
+                    put(i + 1, j + 1, attr, SQUARE)
+    else:
+        for j, text in enumerate(("      ", " GAME ", " OVER ", "      ")):
+            screen.text(w // 2 - 2, h // 2 - 1 + j, text)
+
+    sx = w + 4
+    screen.text(sx, 0, "Next")
+    screen.text(sx, 1, "┌────┐")
+    for j in range(4):
+        screen.text(sx, j + 2, "│    │")
+    for i, j in game.next_piece.cells:
+        put(sx + 1 + i, j + 2, game.next_piece.name, SQUARE)
+    screen.text(sx, 6, "└────┘")
+    side = ["", "Level", str(game.level), "", "Lines", str(game.lines), "", "Score", str(game.score)]
+    if (w, h) != (game.board_width, game.board_height):
+        side += ["", "View", "{},{}".format(left, top)]
+    side.extend(side_extra)
+    for n, line in enumerate(side):
+        screen.text(sx, 7 + n, line)
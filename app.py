@@ -1,27 +1,80 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
+import getpass
+import importlib
+import math
+import os
+import sys
 import time
-import random
 import enum
-import urwid
+import ansi
+import bot
+import core
+import highscores
+import perf
+import replay
 import tetromino
 
+
+class LazyModule:
+    # imports the module on first attribute access. urwid takes longer to
+    # import than everything else here together, and headless users of this
+    # module (server, bench) never draw a widget.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+urwid = LazyModule("urwid")
+
+
 class AppState:
     def __init__(self, statestack):
         self.gamestatestack = statestack
         self.context = statestack.context
-        self.widget = None
+        self._widget = None
+    
+    @property
+    def widget(self):
+        # built on first use, states that are never shown by urwid never
+        # build theirs
+        if self._widget is None:
+            self._widget = self.build_widget()
+        return self._widget
+    
+    @widget.setter
+    def widget(self, widget):
+        self._widget = widget
+    
+    def build_widget(self):
+        return None
     
     def process(self, dt):
         pass
     
-    def render(self, dt):
+    def render(self, alpha):
         pass
     
     def handle_event(self, event):
         pass
     
+    def process_input(self):
+        # apply input handled since the last process step right away,
+        # without waiting for the next step
+        pass
+    
+    def next_deadline(self):
+        # seconds until this state needs to be processed again, None if it
+        # only reacts to input
+        return None
+    
 
 class StateStack:
     def __init__(self, context=None):
@@ -38,14 +91,22 @@ class StateStack:
             self._stack.append(state)
             #self.context.urwid_loop.widget = state.widget
         self._pending.append(push)
+        self._wakeup()
     
     def request_pop(self):
         def pop():
             self._stack.pop()
         self._pending.append(self._stack.pop)
+        self._wakeup()
     
     def request_clear(self):
         self._pending.append(self._stack.clear)
+        self._wakeup()
+    
+    def _wakeup(self):
+        # requests can come from urwid callbacks while the loop is asleep
+        if self.context is not None and self.context.wakeup is not None:
+            self.context.wakeup()
     
     def apply_pending(self):
         if self._pending:
@@ -53,7 +114,7 @@ class StateStack:
                 action()
             self._pending.clear()
             # FIXME: for now with urwid use only the top state for rendering
-            if self._stack:
+            if self._stack and self.context.urwid_loop is not None:
                 self.context.urwid_loop.widget = self._stack[-1].widget
     
     def process(self, dt):
@@ -63,31 +124,80 @@ class StateStack:
         self.apply_pending()
         
         
-    def render(self, dt):
+    def render(self, alpha):
         #FIXME: for now with urwid use only the top state for rendering
         #for state in self_stack:
-        #    state.render(dt)
-        self._stack[-1].render(dt)
+        #    state.render(alpha)
+        self._stack[-1].render(alpha)
         
     
     def handle_event(self, event):
         for state in reversed(self._stack):
             if state.handle_event(event) is not None:
                 break
+    
+    def process_input(self):
+        # only the top state, the ones below are not processed while covered
+        if self._stack:
+            self._stack[-1].process_input()
+        self.apply_pending()
+    
+    def next_deadline(self):
+        if self._pending:
+            return 0
+        #FIXME: like rendering, only the top state counts for now
+        if self._stack:
+            return self._stack[-1].next_deadline()
+        return None
 
                 
 class Context:
     def __init__(self):
         self.loop = None
         self.urwid_loop = None
+        self.wakeup = None
+        self.record_dir = None
+        self.perf = None
+        self.highscores = None
+        # apply keys as soon as they arrive instead of on the next fixed step
+        self.immediate_input = True
+        # screen backend for states that do not draw through urwid
+        self.screen = None
+        # spectator stream the game is sent to, see spectate.py
+        self.broadcast = None
+        # terminal output, and draw the game with ansi.AnsiScreen instead of
+        # urwid widgets
+        self.output = None
+        self.ansi = False
+        # board (width, height) of new games, and sparse row storage for
+        # large boards
+        self.board_size = (10, 22)
+        self.sparse = False
+        # urwid screen updates so far, a state drawing on its own has to
+        # repaint after one
+        self.redraws = 0
 
 
 class Application:
-    def __init__(self, start_state, loop=None):
+    def __init__(self, start_state, loop=None, record_dir=None, perf_json=None, scores=None, ansi=False,
+                 immediate_input=True, board_size=(10, 22), sparse=False, max_fps=60):
         self.context = Context()
+        self.context.board_size = board_size
+        self.context.sparse = sparse
+        self.context.immediate_input = immediate_input
+        self.context.record_dir = record_dir
+        self.context.output = perf.CountingOutput(sys.stdout)
+        self.context.ansi = ansi
+        if scores is not None:
+            self.context.highscores = highscores.HighScoreStore(scores)
+        self.context.perf = perf.FrameStats()
+        self.context.perf.pacer = perf.FramePacer(self.context.output, max_fps)
+        self.perf_json = perf_json
         self.events = []
         self.done = False
         self.gamestatestack = StateStack(self.context)
+        self._wakeup_event = None
+        self.context.wakeup = self.wakeup
         
         if loop is None:
             loop = asyncio.get_event_loop()
@@ -111,73 +221,185 @@ class Application:
                    ("ghost", "dark gray", "default"),
                    ('reversed', 'standout', '')]
                    
-        ml = urwid.MainLoop(dummy_widget, palette,
+        screen = urwid.display.raw.Screen(output=self.context.output)
+        ml = urwid.MainLoop(dummy_widget, palette, screen=screen,
                             event_loop=urwid.AsyncioEventLoop(loop=self.context.loop),
-                            unhandled_input=self.events.append)
+                            unhandled_input=self.on_input)
         self.context.urwid_loop = ml
+        
+        # time urwid's own screen drawing too, and count what it writes
+        draw_screen = ml.draw_screen
+        def timed_draw_screen():
+            output = self.context.output
+            before = output.bytes_written
+            start = time.perf_counter()
+            draw_screen()
+            self.context.perf.add("draw", time.perf_counter() - start)
+            written = output.bytes_written - before
+            if written:
+                self.context.perf.add("bytes", written)
+                self.context.redraws += 1
+            self.context.perf.input.mark("written", time.perf_counter())
+        self.draw_screen = timed_draw_screen
+        # urwid draws after its own input, on the pacer's schedule too; a
+        # frame held back is drawn by run()
+        def paced_draw_screen():
+            if self.events:
+                # run() handles them first and draws then
+                self.wakeup()
+                return
+            pacer = self.context.perf.pacer
+            if pacer.due(time.perf_counter()):
+                before = self.context.output.bytes_written
+                timed_draw_screen()
+                pacer.drawn(self.context.output.bytes_written - before)
+            else:
+                self.wakeup()
+        ml.draw_screen = paced_draw_screen
+        
         ml.start()
     
+    def on_input(self, key):
+        self.events.append(key)
+        self.context.perf.input.arrived(key, time.perf_counter())
+        self.wakeup()
+    
+    def wakeup(self):
+        if self._wakeup_event is not None:
+            self._wakeup_event.set()
+    
     def handle_events(self, dt):
         # handle collected events
         for e in self.events:
             if e == "Q":
                 self.stop()
+            elif e == "f3":
+                self.context.perf.visible = not self.context.perf.visible
+                continue
             self.gamestatestack.handle_event(e)
+        if self.events:
+            stats = self.context.perf
+            stats.input.mark("handled", time.perf_counter())
+            if self.context.immediate_input and not self.done:
+                self.gamestatestack.process_input()
+                stats.input.mark("processed", time.perf_counter())
         self.events.clear()
     
     def process(self, dt):
         self.gamestatestack.process(dt)
 
-    def render(self, dt):
-        self.gamestatestack.render(dt)
+    def render(self, alpha):
+        self.gamestatestack.render(alpha)
     
     async def run(self):
         max_frame_time = 1.0 / 5
         step_size = 1.0 / 60
         prev_time = time.perf_counter()
+        self._wakeup_event = asyncio.Event()
+        planned_sleep = 0
+        stats = self.context.perf
+        pacer = stats.pacer
+        output = self.context.output
         while not self.done:
+            frame_start = time.perf_counter()
             self.handle_events(0)
+            if self.done:
+                # Q stopped urwid and its screen, nothing may draw now
+                break
             # get the current real time
             now = time.perf_counter()
+            stats.add("handle_events", now - frame_start)
         
-            # if elapsed time since last frame is too long...
-            if now - prev_time > max_frame_time:
+            # if elapsed time since last frame is too long... (time we chose
+            # to sleep through does not count)
+            if now - prev_time > max_frame_time + planned_sleep:
                 # slow the game down by resetting clock
                 prev_time = now - step_size
+                stats.dropped_frames += 1
                 # alternatively, do nothing and frames will auto-skip, which
                 # may cause the engine to never render!
         
             # this code will run only when enough time has passed, and will
             # catch up to wall time if needed.
+            steps = 0
             while now - prev_time >= step_size:
                 # save old game state, update new game state based on step_size
                 #update_state(now, step_size)
+                start = time.perf_counter()
                 self.process(step_size)
+                end = time.perf_counter()
+                stats.add("process", end - start)
+                stats.input.mark("processed", end)
                 prev_time += step_size
+                steps += 1
+            stats.add("steps", steps)
             #else:
             #    await asyncio.sleep(0.016) # parameter: time to wait in s
             if self.gamestatestack.is_empty():
                 self.stop()
                 break
 
-            # render game state. use 1.0/(step_size/(T-now)) for interpolation
-            self.render(now - prev_time)
+            # render game state when the pacer says so, the steps in between
+            # are merged into this frame. alpha, the fraction of a step wall
+            # time is past the last one, is for interpolation
+            start = time.perf_counter()
+            if pacer.due(start):
+                before = output.bytes_written
+                self.render((now - prev_time) / step_size)
+                end = time.perf_counter()
+                stats.add("render", end - start)
+                if self.context.ansi:
+                    # the game was written by render
+                    stats.input.mark("written", end)
+                # urwid draws on its own only after its own input, not after
+                # state changes and timers in here
+                self.draw_screen()
+                pacer.drawn(output.bytes_written - before)
+            stats.add("frame", time.perf_counter() - frame_start)
             
-            # yield to other coroutines
-            await asyncio.sleep(0.005)
+            # sleep until the next timer of the active state is due, or until
+            # input or a state change wakes us up
+            deadline = self.gamestatestack.next_deadline()
+            if stats.visible:
+                # keep the overlay fresh
+                deadline = 0.25 if deadline is None else min(deadline, 0.25)
+            if deadline is None:
+                timeout = None
+            else:
+                # timers fire on whole steps, counted from prev_time
+                steps = max(1, math.ceil(deadline / step_size - 1e-9))
+                timeout = max(0, prev_time + steps * step_size - time.perf_counter())
+            if pacer.pending:
+                # wake up for the frame held back
+                wait = max(0, pacer.next_frame - time.perf_counter())
+                timeout = wait if timeout is None else min(timeout, wait)
+            self._wakeup_event.clear()
+            if not self.events and not self.done:
+                try:
+                    await asyncio.wait_for(self._wakeup_event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if deadline is None:
+                # nothing was running while idle, do not catch up on it
+                prev_time = max(prev_time, time.perf_counter() - step_size)
+                planned_sleep = 0
+            else:
+                planned_sleep = timeout
             
     
     def stop(self):
+        if self.perf_json is not None and not self.done:
+            self.context.perf.dump(self.perf_json)
         self.done = True
+        self.wakeup()
         self.context.urwid_loop.stop()
 
         
 class MainMenuState(AppState):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        
+    def build_widget(self):
         body = [urwid.Text(u"Baby's First Tetris"), urwid.Divider()]
         buttons = [("Play", lambda _: self.gamestatestack.request_push(PlayGameState)),
+                   ("Watch the Bot", lambda _: self.gamestatestack.request_push(BotState)),
                    ("High Scores", lambda _: self.gamestatestack.request_push(HighScoreState)),
                    ("Exit", lambda _: self.gamestatestack.request_clear())]
         for name, callback in buttons:
@@ -186,7 +408,7 @@ class MainMenuState(AppState):
             body.append(urwid.AttrMap(button, None, focus_map="reversed"))
         listbox = urwid.ListBox(urwid.SimpleFocusListWalker(body))
         
-        self.widget = urwid.Padding(listbox)
+        return urwid.Padding(listbox)
     
     def handle_event(self, event):
         # MainMenuState uses urwid for now
@@ -194,9 +416,7 @@ class MainMenuState(AppState):
 
 
 class PauseState(AppState):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        
+    def build_widget(self):
         body = [urwid.Text(u"PAUSE"), urwid.Divider()]
         buttons = [("Continue playing", lambda _: self.gamestatestack.request_pop()),
                    ("Return to Main Menu", self.menu_main_menu)]
@@ -206,7 +426,7 @@ class PauseState(AppState):
             body.append(urwid.AttrMap(button, None, focus_map="reversed"))
         listbox = urwid.ListBox(urwid.SimpleFocusListWalker(body))
         
-        self.widget = urwid.Padding(listbox)
+        return urwid.Padding(listbox)
     
     def menu_main_menu(self, button):
         # TO DO: ask are you sure...
@@ -214,41 +434,119 @@ class PauseState(AppState):
         self.gamestatestack.request_push(MainMenuState)
     
     def handle_event(self, event):
-        # MainMenuState uses urwid for now
-        pass
+        # the menu uses urwid, keys it does not take must not reach the
+        # paused game
+        return True
     
     def process(self, dt):
         # do not allow the lower states to update
         return True
 
 
+# urwid markup of the board, one segment per run of cells in one color
+EMPTY_CELL = ("ghost", "|")
+PIECE_MARKUP = {}
+
+
+def row_markup(colors, left, width, ghost=0, piece=0, attr=None, text=None, text_x=0):
+    # width cells of a board row from left. ghost and piece are masks of the
+    # board columns they cover, text is written over the cells from text_x.
+    markup = []
+    run_attr, run = False, []
+    for n in range(width):
+        i = left + n
+        if text is not None and 0 <= n - text_x < len(text):
+            a, char = None, text[n - text_x]
+        elif piece >> i & 1:
+            a, char = attr, ansi.SQUARE
+        elif ghost >> i & 1:
+            a, char = "ghost", ansi.SQUARE
+        elif tetromino.is_block(colors[i]):
+            a, char = colors[i], ansi.SQUARE
+        else:
+            a, char = EMPTY_CELL
+        if a != run_attr:
+            if run:
+                markup.append((run_attr, "".join(run)))
+            run_attr, run = a, []
+        run.append(char)
+    markup.append((run_attr, "".join(run)))
+    return markup
+
+
+def piece_markup(piece, attr):
+    # the piece in its 4x4 box, cached per piece, rotation and color
+    key = (piece.name, piece.which, attr)
+    if key not in PIECE_MARKUP:
+        markup = []
+        for row in piece.shape():
+            if markup:
+                markup.append("\n")
+            markup.extend((attr, ansi.SQUARE) if tetromino.is_block(c) else " " for c in row)
+        PIECE_MARKUP[key] = markup
+    return PIECE_MARKUP[key]
+
+
 class PlayGameState(AppState):
-    FALLING = 0
-    LANDED = 1
-    LOCKED = 2
-    CLEARING = 3
-    GAMEOVER = 4
+    FALLING = core.GameCore.FALLING
+    LANDED = core.GameCore.LANDED
+    LOCKED = core.GameCore.LOCKED
+    CLEARING = core.GameCore.CLEARING
+    GAMEOVER = core.GameCore.GAMEOVER
+    # whether games are written to the record directory
+    recorded = True
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
     
-        self.board_width = 10
-        self.board_height = 22
-        self.board = tetromino.make_board(self.board_height, self.board_width)
-        self.score = 0
-        self.level = 1
-        self.lines = 0
-        self.piece = None
-        self.next_piece = None
+        board_width, board_height = self.context.board_size
+        self.core = core.GameCore(board_width, board_height, sparse=self.context.sparse)
+        self.board_width = self.core.board_width
+        self.board_height = self.core.board_height
+        
+        # boards larger than the terminal scroll
+        cols, rows = 80, 24
+        if self.context.urwid_loop is not None:
+            cols, rows = self.context.urwid_loop.screen.get_cols_rows()
+        self.screen_size = cols, rows
+        self.view = ansi.Viewport(self.core, cols - 34, rows - 2)
+        
+        self.diag_text = ""
+        self.diag_shown = ""
+
+        self.ansi_screen = None
+        if self.context.ansi:
+            self.ansi_screen = ansi.AnsiScreen(self.write_output, cols, rows)
+            self.redraws = -1
+
+        # markup per view row and the row version it shows, None for rows
+        # drawn over that have to be redrawn next frame
+        self.row_markup = [None] * self.view.height
+        self.row_shown = [None] * self.view.height
+        self.markup_origin = None
+        self.level_shown = self.score_shown = self.lines_shown = None
+        self.next_shown = None
+
+        self.events = []
         
-        self.new_tetromino()
+        self.player = getpass.getuser()
+        self.finished = False
         
-        self.diag_text = [""]
-        self.diag_display = urwid.Text("")
+        self.recorder = None
+        if self.recorded and self.context.record_dir is not None:
+            filename = "{}-{}.jsonl".format(time.strftime("%Y%m%d-%H%M%S"), self.core.seed)
+            self.recorder = replay.Recorder(os.path.join(self.context.record_dir, filename), self.core,
+                                            self.context.immediate_input)
+    
+    def build_widget(self):
+        if self.ansi_screen is not None:
+            # urwid only draws a blank background, the game is drawn on top
+            return urwid.SolidFill(" ")
 
+        self.diag_display = urwid.Text("")
         self.board_display = urwid.Text("")
         w = urwid.LineBox(self.board_display)
-        play_widget = urwid.Padding(w, width=self.board_width + 2)
+        play_widget = urwid.Padding(w, width=self.view.width + 2)
         
         self.score_display = urwid.Text("")
         self.level_display = urwid.Text("")
@@ -261,311 +559,238 @@ class PlayGameState(AppState):
         w = urwid.Padding(w, width=4 + 2)
         next_widget = urwid.Pile([urwid.Text("Next"), w])
         
-        w = urwid.Columns([(22, play_widget), \
+        w = urwid.Columns([(self.view.width + 12, play_widget), \
                           urwid.Pile([next_widget,
                                       urwid.Divider(),
                                       self.level_display,
                                       urwid.Divider(),
                                       self.lines_display,
                                       urwid.Divider(),
-                                      self.score_display])])
-        self.widget = urwid.Filler(w, 'top')
+                                      self.score_display,
+                                      urwid.Divider(),
+                                      self.diag_display])])
         #self.widget = urwid.Overlay(w,#urwid.ListBox(urwid.SimpleListWalker(listbox_content)),
                                     #urwid.SolidFill("\u2591"),
                                     #align="center", width=12,
                                     #valign="middle", height=60)
-
-
-        
-        self.dirty = True
-        
-        self.gamestate = PlayGameState.FALLING
-
-        self.events = []
-        
-        self.gravity_interval = 0.5 # seconds
-        self.time_since_last_gravity = 0
-        
-        self.lock_interval = self.gravity_interval
-        self.time_since_landed = 0
-        
-        self.clear_effect = 1
-        self.time_since_locked = 0
-        self.rows_to_clear = []
-
-    def new_tetromino(self):
-        def random_tetromino():
-            name = random.choice(list(tetromino.Tetromino.available_templates.keys()))
-            return tetromino.Tetromino(name, 0)
-
-        self.piece, self.next_piece = self.next_piece, random_tetromino()
-        if self.piece is None:
-            self.piece = random_tetromino()
-        
-        self.x = (self.board_width - self.piece.width()) // 2
-        self.y = 0
-        self.floor_kick = False
-        
+        return urwid.Filler(w, 'top')
+    
+    @property
+    def gamestate(self):
+        return self.core.gamestate
+    
+    def write_output(self, data):
+        self.context.output.write(data)
+        self.context.output.flush()
     
     def handle_event(self, inputevent):
         if self.gamestate is not PlayGameState.GAMEOVER:
+            if self.recorder is not None:
+                self.recorder.record(self.core.tick, inputevent)
             if inputevent == "esc":
                 self.gamestatestack.request_push(PauseState)
-            elif inputevent == "a":
-                self.events.append("left")
-            elif inputevent == "d":
-                self.events.append("right")
-            elif inputevent == "q":
-                self.events.append("rotate_left")
-            elif inputevent == "e":
-                self.events.append("rotate_right")
-            elif inputevent == "s":
-                self.events.append("drop")
-            elif inputevent == "w":
-                self.events.append("harddrop")
+            elif inputevent in core.KEYMAP:
+                self.events.append(core.KEYMAP[inputevent])
         else:
-            #self.gamestatestack.request_push(HighscoreState)
+            self.finish()
+            self.gamestatestack.request_clear()
             self.gamestatestack.request_push(MainMenuState)
+            self.gamestatestack.request_push(HighScoreState, self.core.level, self.core.score)
         return True
         
     
-    def process(self, dt):
-        # early exit
-        if self.gamestate is PlayGameState.GAMEOVER:
+    def next_deadline(self):
+        if self.events:
+            return 0
+        return self.core.time_to_next_event()
+    
+    def process_input(self):
+        if self.events:
+            self.core.step(self.events, 0)
             self.events.clear()
-            return True
-        
-        # update timed events, if needed add them to the event queue
-        if self.gamestate in [PlayGameState.FALLING, PlayGameState.LANDED]:
-            self.time_since_last_gravity += dt
-            while self.time_since_last_gravity >= self.gravity_interval:
-                self.events.append("gravity") # TO DO: insert at the correct time
-                self.time_since_last_gravity -= self.gravity_interval
-
-        if self.gamestate is PlayGameState.LANDED:
-            self.time_since_landed += dt
-            if self.time_since_landed >= self.lock_interval:
-                self.events.append("locktimeout") # TO DO: insert at the correct time
-                #self.gamestate = PlayGameState.LOCKED
-            
-            
-        # process the events and change the state of the game
-        for event in self.events:
-            if self.gamestate in [PlayGameState.FALLING, PlayGameState.LANDED]:
-                if event == "left":
-                    self.attempt_move_by(self.piece, -1, 0)
-                        
-                elif event == "right":
-                    self.attempt_move_by(self.piece, 1, 0)
-                
-                elif event == "rotate_left":
-                    self.attempt_rotate(-1)
-                                
-                elif event == "rotate_right":
-                    self.attempt_rotate(1)
-            
-            if self.gamestate is PlayGameState.FALLING:
-                if event in ["drop", "gravity"]:
-                    if not self.attempt_drop(event):
-                        self.gamestate = PlayGameState.LANDED
-                        self.time_since_landed = 0
-
-                elif event == "harddrop":
-                    _, y = self.get_ghost_coords()
-                    self.score += (y - self.y) * 2
-                    self.y = y
-                    self.gamestate = PlayGameState.LOCKED
-            
-            elif self.gamestate is PlayGameState.LANDED:
-                if event in ["drop", "harddrop", "locktimeout", "gravity"]:
-                    self.gamestate = PlayGameState.LOCKED
-                
-                elif self.test_move_by(self.piece, 0, 1): # did we move away from the obstacle?
-                    self.gamestate = PlayGameState.FALLING
-
-            
-            if self.gamestate == PlayGameState.LOCKED:
-                self.put_into_board()
-                if self.past_top():
-                    self.gamestate = PlayGameState.GAMEOVER
-                    break
-                else:
-                    cleared = self.clear_rows()
-                    self.add_score(cleared)
-                    self.new_tetromino()
-                    self.time_since_last_gravity = 0
-                    if tetromino.check_collision(self.board, self.piece, self.x, self.y):  #FIXME
-                        self.gamestate = PlayGameState.GAMEOVER
-                    else:
-                        self.gamestate = PlayGameState.FALLING
-
+            # a hard drop applied here can end the game without another
+            # fixed step coming
+            self.finish()
+        return True
+    
+    def process(self, dt):
+        # the application calls us once per fixed step, which is one core tick
+        self.core.step(self.events)
         self.events.clear()
+        self.finish()
 
         # do not allow the lower app states to update
         return True
     
-    def add_score(self, cleared):
-        scoring = {0:0, 1:40, 2:100, 3:300, 4:1200}
-        self.score += self.level * scoring[cleared]
-        self.lines += cleared
+    def finish(self):
+        # once, when the game is over: close the recording, add the score
+        if self.gamestate is not PlayGameState.GAMEOVER or self.finished:
+            return
+        self.finished = True
+        replay_id = None
+        if self.recorder is not None:
+            self.recorder.finish(self.core)
+            replay_id = os.path.basename(self.recorder.filename)
+        if self.player is not None and self.context.highscores is not None:
+            game = self.core
+            self.context.highscores.add(self.player, game.level, game.score, game.lines, replay_id)
+    
+    
+    def render(self, alpha):
+        if self.ansi_screen is not None:
+            return self.render_ansi()
+        
+        if self._widget is None:
+            # the text widgets drawn into are built with the widget tree
+            self.widget = self.build_widget()
+        
+        game = self.core
+        if game.dirty:
+            # the side panel, only the values that changed
+            if game.level != self.level_shown:
+                self.level_display.set_text("Level\n{}".format(game.level))
+                self.level_shown = game.level
+            if game.score != self.score_shown:
+                self.score_display.set_text("Score\n{}".format(game.score))
+                self.score_shown = game.score
+            if game.lines != self.lines_shown:
+                self.lines_display.set_text("Lines\n{}".format(game.lines))
+                self.lines_shown = game.lines
+            if game.next_piece is not None and game.next_piece is not self.next_shown:
+                self.next_piece_display.set_text(piece_markup(game.next_piece, game.next_piece.name))
+                self.next_shown = game.next_piece
+
+            self.board_display.set_text(self.board_markup(game))
+            game.dirty = False
+
+        # diagnostics, and the perf overlay when it is switched on
+        stats = self.context.perf
+        diag = self.diag_text
+        if stats is not None and stats.visible:
+            diag = [diag, "\n" if diag else "", stats.overlay_text(*self.overlay_space())]
+        if diag != self.diag_shown:
+            self.diag_display.set_text(diag)
+            self.diag_shown = diag
+        return True
+    
+    def overlay_space(self):
+        # lines and columns left for the perf overlay under the side panel
+        cols, rows = self.screen_size
+        diag_lines = self.diag_text.count("\n") + 1 if self.diag_text else 0
+        if self.ansi_screen is not None:
+            # draw_game: next piece, level, lines and score, the view
+            # position when scrolling, a blank line
+            scrolling = (self.view.width, self.view.height) != (self.board_width, self.board_height)
+            top = 17 + (3 if scrolling else 0)
+            return rows - top - diag_lines, cols - self.view.width - 4
+        # build_widget: next piece, level, lines and score with dividers
+        return rows - 17 - diag_lines, cols - self.view.width - 12
+
+    def board_markup(self, game):
+        # only the rows that changed since the last frame are built again
+        left, top = self.view.follow(game)
+        view_width, view_height = self.view.width, self.view.height
+        board = game.board
+        if self.markup_origin != (board, left, top):
+            self.row_shown = [None] * view_height
+            self.markup_origin = (board, left, top)
+
+        # rows under the piece, the ghost or the game over text
+        overlay = {}
+        if game.piece:
+            gx, gy = game.get_ghost_coords()
+            for j, bits, lo, hi in game.piece.rows:
+                ghost, piece, _ = overlay.get(gy + j - top, (0, 0, None))
+                overlay[gy + j - top] = (ghost | bits << (gx + lo), piece, None)
+            for j, bits, lo, hi in game.piece.rows:
+                ghost, piece, _ = overlay.get(game.y + j - top, (0, 0, None))
+                overlay[game.y + j - top] = (ghost, piece | bits << (game.x + lo), None)
+        if game.gamestate is PlayGameState.GAMEOVER:
+            for n, text in enumerate(("      ", " GAME ", " OVER ", "      ")):
+                ghost, piece, _ = overlay.get(view_height // 2 - 2 + n, (0, 0, None))
+                overlay[view_height // 2 - 2 + n] = (ghost, piece, text)
+
+        for n in range(view_height):
+            j = top + n
+            if n in overlay:
+                ghost, piece, text = overlay[n]
+                self.row_markup[n] = row_markup(board.row_colors(j), left, view_width,
+                                                ghost, piece, game.piece.name, text,
+                                                view_width // 2 - 3)
+                self.row_shown[n] = None
+            elif self.row_shown[n] != board.row_version(j):
+                self.row_markup[n] = row_markup(board.row_colors(j), left, view_width)
+                self.row_shown[n] = board.row_version(j)
+
+        markup = []
+        for n, row in enumerate(self.row_markup):
+            if n:
+                markup.append("\n")
+            markup.extend(row)
+        return markup
+
+    def render_ansi(self):
+        game = self.core
+        stats = self.context.perf
+        diag = self.diag_text
+        if stats is not None and stats.visible:
+            diag = "\n".join(s for s in (diag, stats.overlay_text(*self.overlay_space())) if s)
+        if self.redraws != self.context.redraws:
+            # urwid drew over the game
+            self.redraws = self.context.redraws
+            self.ansi_screen.invalidate()
+            game.dirty = True
+        if game.dirty or diag != self.diag_shown:
+            ansi.draw_game(self.ansi_screen, game, [""] + diag.split("\n"), self.view)
+            written = self.ansi_screen.flush()
+            if written and stats is not None:
+                stats.add("bytes", written)
+            game.dirty = False
+            self.diag_shown = diag
+        return True
 
 
-    def test_move_by(self, piece, dx, dy):
-        crossed_borders = tetromino.check_in_board(self.board, piece, self.x + dx, self.y + dy)
-        if crossed_borders is None:
-            collisions = tetromino.check_collision(self.board, piece, self.x + dx, self.y + dy)
-            if collisions is None:
-                return True
-        return False
-    
-    
-    def attempt_move_by(self, piece, dx, dy):
-        if self.test_move_by(self.piece, dx, dy):
-            self.x += dx
-            self.y += dy
-            self.dirty = True
-            return True
-        return False
-    
-    
-    def test_rotate(self, rot):
-        rp = tetromino.Tetromino(self.piece.name, self.piece.which + rot)
-        for dx, dy in rp.kicks:
-            if self.test_move_by(rp, dx, dy):
-                floor_kick = (dy == -1)
-                return dx, dy, floor_kick
-        return None
-    
-    
-    def attempt_rotate(self, rot):
-        res = self.test_rotate(rot)
-        if res is not None and not self.floor_kick:
-            dx, dy, self.floor_kick = res
-            self.piece = tetromino.Tetromino(self.piece.name, self.piece.which -1)
-            self.x += dx
-            self.y += dy
-            self.dirty = True
-            return True
-        return False
-    
+class BotState(PlayGameState):
+    # the bot does not press keys, there is nothing to record
+    recorded = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # and it stays off the high score table
+        self.player = None
+        self.bot = bot.Bot(lookahead=True, time_budget=0.05)
+        self.plan = []
+        self.plan_piece = None
     
-    def attempt_drop(self, event): # return True if dropped, False if landed
-        self.time_since_last_gravity = 0
-        if self.test_move_by(self.piece, 0, 1):
-            self.y += 1
-            if event == "drop":
-                self.score += 1
-            self.dirty = True
-            return True
+    def handle_event(self, inputevent):
+        if self.gamestate is not PlayGameState.GAMEOVER:
+            if inputevent == "esc":
+                self.gamestatestack.request_push(PauseState)
         else:
-            return False
-        
-        
-    def get_ghost_coords(self):
-        dy = 0
-        while self.test_move_by(self.piece, 0, dy + 1):
-            dy += 1
-        return self.x, self.y + dy
-        
-    
-    def past_top(self):
-        for row in self.board[0:2]:
-            for c in row:
-                if tetromino.is_block(c):
-                    return True
-        return False
-    
-    
-    def put_into_board(self):
-        for j, row in enumerate(self.piece.shape()):
-            for i, c in enumerate(row):
-                if tetromino.is_block(c):
-                    try:
-                        self.board[self.y + j][self.x + i] = self.piece.name
-                    except:
-                        pass
-        self.dirty = True
-
-    
-    def clear_rows(self):
-        def row_full(row):
-            for c in row:
-                if not tetromino.is_block(c):
-                    return False
-            return True
-        
-        rows_to_delete = []
-        
-        for j, row in enumerate(self.board):
-            if row_full(row):
-                rows_to_delete.append(j)
-        
-        for index in reversed(rows_to_delete):
-            del self.board[index]
-        
-        self.board = tetromino.make_board(len(rows_to_delete), self.board_width) + self.board
-        
-        self.dirty = True
-        
-        return len(rows_to_delete)
-                
+            self.finish()
+            self.gamestatestack.request_clear()
+            self.gamestatestack.request_push(MainMenuState)
+        return True
     
+    def next_deadline(self):
+        if self.gamestate is PlayGameState.GAMEOVER:
+            return None
+        return 0
     
-    def render(self, dt):
-        square = "\N{WHITE SQUARE CONTAINING BLACK SMALL SQUARE}"
-        empty = ("ghost", "|")        
-        def flatten_text(char_array, delimiter="\n"):
-            rows = iter(char_array)
-            yield from next(rows)
-            for row in rows:
-                yield delimiter
-                yield from row
-        
-        def render_piece(piece, color):
-            return [[(color, square) if tetromino.is_block(c) else " " for c in row] for row in piece.shape()]
-        
-        def render_piece_into_board(text, piece, x, y):
-            for j, row in enumerate(piece):
-                for i, c in enumerate(row):
-                    if tetromino.is_block(c):
-                        text[j + y][i + x] = c
-        
-        def render_chars_into_board(text, chars, x, y):
-            for j, row in enumerate(chars):
-                for i, c in enumerate(row):
-                    text[j + y][i + x] = c
-
-
-        if self.dirty:
-            # update score and level
-            self.level_display.set_text("Level\n{self.level}".format(self=self))
-            self.score_display.set_text("Score\n{self.score}".format(self=self))
-            self.lines_display.set_text("Lines\n{self.lines}".format(self=self))
-            
-            # render next
-            if self.next_piece:
-                self.next_piece_display.set_text(list(flatten_text(render_piece(self.next_piece, self.next_piece.name))))
-
-            # render board
-            out = [[(c, square) if tetromino.is_block(c) else empty for c in row] for row in self.board]
-            
-            if self.piece:
-                # render ghost
-                render_piece_into_board(out, render_piece(self.piece, "ghost"), *self.get_ghost_coords())
-                
-                # render piece
-                render_piece_into_board(out, render_piece(self.piece, self.piece.name), self.x, self.y)
-                
-            # game over?
-            if self.gamestate == PlayGameState.GAMEOVER:
-                render_chars_into_board(out, ("      ", " GAME ", " OVER ", "      ",), \
-                                        self.board_width // 2 - 3, self.board_height // 2 - 2)
-            
-            self.board_display.set_text(list(flatten_text(out)))
-            self.diag_display.set_text(self.diag_text)
-            
-            self.dirty = False
-        return True
+    def process(self, dt):
+        # gravity locked the piece before the plan was done, the rest of
+        # it would move the next piece
+        if self.plan and self.core.pieces != self.plan_piece:
+            self.plan = []
+        if self.gamestate is PlayGameState.FALLING and not self.plan:
+            placement = self.bot.choose(self.core)
+            self.plan = ["harddrop"] if placement is None else list(placement.moves)
+            self.plan_piece = self.core.pieces
+            self.diag_text = "{pieces_per_second:.1f} pieces/s {nodes_per_second:.0f} nodes/s".format(**self.bot.stats())
+        # one move per step, so the moves can be watched
+        if self.plan:
+            self.events.append(self.plan.pop(0))
+        return super().process(dt)
 
 
 # a bit of gui magic
@@ -574,55 +799,112 @@ def cols(a, b, c):
                           (10, urwid.Text(b)),
                           (10, urwid.Text(c))])
                           
-class Row(urwid.WidgetWrap):
-    def __init__(self, a, b, c):
-        # wrap in AttrMap to highlight when selected
-        super().__init__(urwid.AttrMap(cols(a, b, c), None, 'reversed'))
+def make_row_class():
+    class Row(urwid.WidgetWrap):
+        def __init__(self, a, b, c):
+            # wrap in AttrMap to highlight when selected
+            super().__init__(urwid.AttrMap(cols(a, b, c), None, 'reversed'))
+
+        def selectable(self):
+            # these widgets want the focus
+            return True
 
-    def selectable(self):
-        # these widgets want the focus
-        return True
+        def keypress(self, size, key):
+            # handle keys as you will
+            return key
+    return Row
 
-    def keypress(self, size, key):
-        # handle keys as you will
-        return key
+
+def __getattr__(name):
+    # Row subclasses a urwid widget, it is defined on first use so that
+    # importing this module does not import urwid
+    if name == "Row":
+        globals()["Row"] = make_row_class()
+        return globals()["Row"]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class HighScoreState(AppState):
+    page_size = 20
+    
     def __init__(self, statestack, level=None, score=None):
         super().__init__(statestack)
 
-        self.highscore = self.from_file(None)
+        self.start = 0
         
         #if level is None or score is None:
             # just display the high score table
         #else:
             # allow editing
 
+        self.walker = None
+    
+    def build_widget(self):
         title = urwid.Text(u"High Scores")
         header = cols("Name", "Level", "Score")
-        rows = [cols(name, str(level), str(score)) for name, level, score in self.highscore]
-        listbox = urwid.ListBox(urwid.SimpleListWalker(rows))
-        
-        self.widget = urwid.Frame(listbox, header=header)
+        self.walker = urwid.SimpleListWalker([])
+        listbox = urwid.ListBox(self.walker)
+        footer = urwid.Text("page up/down: more, enter: back")
+        
+        widget = urwid.Frame(listbox, header=urwid.Pile([title, header]), footer=footer)
+        self.show_page(self.start)
+        return widget
+    
+    def show_page(self, start):
+        # only the shown page is read from the store, nothing is read
+        # before the table is on screen
+        if self.walker is None:
+            return
+        store = self.context.highscores
+        entries = [] if store is None else store.page(start, self.page_size)
+        if not entries and start > 0:
+            return
+        self.start = start
+        rows = [cols("{rank}. {name}".format(**e), str(e["level"]), str(e["score"])) for e in entries]
+        if not rows:
+            rows = [urwid.Text("No high scores yet")]
+        self.walker[:] = rows
     
     def handle_event(self, event):
         if event in ('enter', 'esc'):
             self.gamestatestack.request_pop()
+        elif event == 'page down':
+            self.show_page(self.start + self.page_size)
+        elif event == 'page up':
+            self.show_page(max(0, self.start - self.page_size))
     
     def process(self, dt):
         # do not allow the lower states to update
         return True
-    
-    def from_file(self, filename):
-        # TO DO
-        return [("Player " + str(i + 1), 10, (10 - i) * 1000) for i in range(10)]
 
         
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Baby's First Tetris")
+    parser.add_argument("--record", metavar="DIR", default=None,
+                        help="write an input log of every game into DIR, see replay.py")
+    parser.add_argument("--perf-json", metavar="FILE", default=None,
+                        help="write frame timing statistics to FILE on exit, F3 shows them live")
+    parser.add_argument("--scores", metavar="PATH",
+                        default=os.path.join(os.path.expanduser("~"), ".tetris-scores"),
+                        help="high score store, PATH.log and PATH.idx are created")
+    parser.add_argument("--ansi", action="store_true",
+                        help="draw the game with the diffing ANSI renderer instead of urwid widgets")
+    parser.add_argument("--board", metavar="WxH", default="10x22",
+                        type=lambda s: tuple(int(n) for n in s.lower().split("x")),
+                        help="board size, boards larger than the terminal scroll")
+    parser.add_argument("--sparse", action="store_true",
+                        help="store only the rows under the stack, for very large boards")
+    parser.add_argument("--tick-input", action="store_true",
+                        help="apply keys on the next fixed step instead of as soon as they arrive")
+    parser.add_argument("--max-fps", type=int, default=60,
+                        help="screen updates per second at most, fewer when the terminal is slow")
+    args = parser.parse_args()
+    
     loop = asyncio.get_event_loop()
-    app = Application(PlayGameState, loop=loop)
+    app = Application(PlayGameState, loop=loop, record_dir=args.record, perf_json=args.perf_json,
+                      scores=args.scores, ansi=args.ansi, immediate_input=not args.tick_input,
+                      board_size=args.board, sparse=args.sparse, max_fps=args.max_fps)
     print("Starting.")
     loop.run_until_complete(app.run())
@@ -0,0 +1,318 @@
+import numpy as np
+import core
+import tetromino
+
+
+# N independent games advanced in lockstep with numpy. Same rules as
+# core.GameCore, but every state is an array over the batch and collisions,
+# drops, locks and line clears are done for all games at once.
+#
+# Board rows are uint32 bitmasks with the playfield in bits
+# PAD_X .. PAD_X + board_width - 1. Everything outside the playfield (the
+# walls, PAD_Y rows above the top and below the bottom) is set, so a single
+# AND answers both check_in_board and check_collision.
+
+PAD_X = 4
+PAD_Y = 4
+
+ACTIONS = ("none", "left", "right", "rotate_left", "rotate_right", "drop", "harddrop")
+NONE, LEFT, RIGHT, ROTATE_LEFT, ROTATE_RIGHT, DROP, HARDDROP = range(len(ACTIONS))
+# timed events, never passed in by the caller
+GRAVITY = len(ACTIONS)
+LOCKTIMEOUT = GRAVITY + 1
+
+PIECES = tetromino.PIECE_NAMES
+
+
+def make_tables():
+    num = len(PIECES)
+    masks = np.zeros((num, 4, 4), dtype=np.uint32)
+    sizes = np.zeros(num, dtype=np.int16)
+    # kick offsets by kick sign, then piece and kick
+    num_kicks = max(len(tetromino.piece_state(name).kicks[-1]) for name in PIECES)
+    kick_dx = {sign: np.zeros((num, num_kicks), dtype=np.int16) for sign in tetromino.KICK_SIGNS}
+    kick_dy = {sign: np.zeros((num, num_kicks), dtype=np.int16) for sign in tetromino.KICK_SIGNS}
+    kick_valid = np.zeros((num, num_kicks), dtype=bool)
+    for p, name in enumerate(PIECES):
+        for rot in range(4):
+            t = tetromino.piece_state(name, rot)
+            sizes[p] = t.width()
+            for i, j in t.cells:
+                masks[p, rot, j] |= 1 << i
+        for sign, kicks in tetromino.piece_state(name).kicks.items():
+            for k, (dx, dy) in enumerate(kicks):
+                kick_dx[sign][p, k], kick_dy[sign][p, k], kick_valid[p, k] = dx, dy, True
+    return masks, sizes, kick_dx, kick_dy, kick_valid
+
+
+MASKS, SIZES, KICK_DX, KICK_DY, KICK_VALID = make_tables()
+
+
+class BatchGame:
+    FALLING = core.GameCore.FALLING
+    LANDED = core.GameCore.LANDED
+    LOCKED = core.GameCore.LOCKED
+    GAMEOVER = core.GameCore.GAMEOVER
+
+    def __init__(self, n, board_width=10, board_height=22, seed=None, step_size=1.0 / 60):
+        if board_width + 2 * PAD_X > 32:
+            raise ValueError("board too wide for the batch engine: ", board_width)
+        self.n = n
+        self.board_width = board_width
+        self.board_height = board_height
+        self.step_size = step_size
+        self.gravity_interval = 0.5 # seconds per row at level 1
+        self.lock_interval = self.gravity_interval
+        self.lines_per_level = 10
+        # as in GameCore, for all games of the batch
+        self.scoring = core.SCORING
+        self.kick_sign = -1
+        self.rng = np.random.default_rng(seed)
+
+        self.field = np.uint32(((1 << board_width) - 1) << PAD_X)
+        self.wall = ~self.field
+        self.solid = np.uint32(0xFFFFFFFF)
+
+        self.rows = np.empty((n, board_height + 2 * PAD_Y), dtype=np.uint32)
+        self.piece = np.zeros(n, dtype=np.int16)
+        self.next_piece = np.zeros(n, dtype=np.int16)
+        self.which = np.zeros(n, dtype=np.int16)
+        self.x = np.zeros(n, dtype=np.int16)
+        self.y = np.zeros(n, dtype=np.int16)
+        self.floor_kick = np.zeros(n, dtype=bool)
+        self.gamestate = np.zeros(n, dtype=np.int8)
+        self.time_since_last_gravity = np.zeros(n)
+        self.time_since_landed = np.zeros(n)
+        self.score = np.zeros(n, dtype=np.int64)
+        self.level = np.ones(n, dtype=np.int64)
+        self.lines = np.zeros(n, dtype=np.int64)
+        self.spawned = np.zeros(n, dtype=bool)
+        self.tick = 0
+
+        self.reset()
+
+    @property
+    def done(self):
+        return self.gamestate == BatchGame.GAMEOVER
+
+    def reset(self, mask=None):
+        # start fresh games in the selected slots (all of them by default)
+        idx = np.arange(self.n) if mask is None else np.flatnonzero(mask)
+        self.rows[idx] = self.wall
+        self.rows[idx, :PAD_Y] = self.solid
+        self.rows[idx, PAD_Y + self.board_height:] = self.solid
+        self.next_piece[idx] = self.rng.integers(len(PIECES), size=len(idx))
+        self.score[idx] = 0
+        self.level[idx] = 1
+        self.lines[idx] = 0
+        self._spawn(idx)
+
+    def playfield(self, i):
+        # board of game i as a list of plain row masks, bit 0 is column 0
+        rows = self.rows[i, PAD_Y:PAD_Y + self.board_height] & self.field
+        return [int(r) >> PAD_X for r in rows]
+
+    def step(self, actions=None, ticks=1):
+        # actions is an int array of shape (n,) with indices into ACTIONS,
+        # applied on the first tick like GameCore.step()
+        for _ in range(ticks):
+            self._tick(actions)
+            actions = None
+        return self.gamestate
+
+    def _tick(self, actions):
+        self.tick += 1
+        dt = self.step_size
+        state = self.gamestate
+
+        # update timers
+        active = (state == BatchGame.FALLING) | (state == BatchGame.LANDED)
+        self.time_since_last_gravity[active] += dt
+        interval = self.gravity()
+        gravity_rows = np.zeros(self.n, dtype=np.int64)
+        gravity_rows[active] = np.floor_divide(self.time_since_last_gravity[active], interval[active])
+        self.time_since_last_gravity -= gravity_rows * interval
+
+        landed = state == BatchGame.LANDED
+        self.time_since_landed[landed] += dt
+        locktimeout = landed & (self.time_since_landed >= self.lock_interval)
+
+        # same order as the event list in GameCore: input, gravity, lock
+        # timeout. Timed events are dropped for games that spawned a new piece.
+        self.spawned = np.zeros(self.n, dtype=bool)
+        if actions is not None:
+            actions = np.asarray(actions)
+            idx = np.flatnonzero(actions != NONE)
+            self._process_event(idx, actions[idx])
+        idx = np.flatnonzero((gravity_rows > 0) & ~self.spawned)
+        self._process_event(idx, np.full(len(idx), GRAVITY), gravity_rows[idx])
+        idx = np.flatnonzero(locktimeout & ~self.spawned)
+        self._process_event(idx, np.full(len(idx), LOCKTIMEOUT))
+
+    def fits(self, idx, piece, which, x, y):
+        # vectorized test_move_by for the games idx at the given positions
+        shift = x.astype(np.int64) + PAD_X
+        top = y.astype(np.int64) + PAD_Y
+        inside = (shift >= 0) & (shift <= 32 - 4) & (top >= 0) & (top <= self.rows.shape[1] - 4)
+        shift = np.clip(shift, 0, 32 - 4)
+        top = np.clip(top, 0, self.rows.shape[1] - 4)
+        board = self.rows[idx[:, None], top[:, None] + np.arange(4)]
+        shape = MASKS[piece, which % 4] << shift.astype(np.uint32)[:, None]
+        return inside & ~(board & shape).any(axis=1)
+
+    def gravity(self):
+        # seconds per row for every game, same curve as GameCore.gravity()
+        level = np.minimum(self.level - 1, 19)
+        interval = self.gravity_interval * (0.8 - level * 0.007) ** level
+        return np.maximum(interval, self.step_size / 20)
+
+    def _process_event(self, idx, events, gravity_rows=None):
+        if len(idx) == 0:
+            return
+        state = self.gamestate[idx]
+        moving = (state == BatchGame.FALLING) | (state == BatchGame.LANDED)
+
+        for event, dx in ((LEFT, -1), (RIGHT, 1)):
+            sel = idx[moving & (events == event)]
+            if len(sel):
+                ok = self.fits(sel, self.piece[sel], self.which[sel], self.x[sel] + dx, self.y[sel])
+                self.x[sel[ok]] += dx
+
+        for event, rot in ((ROTATE_LEFT, -1), (ROTATE_RIGHT, 1)):
+            sel = idx[moving & (events == event)]
+            sel = sel[~self.floor_kick[sel]]
+            if len(sel):
+                self._rotate(sel, rot)
+
+        falling = state == BatchGame.FALLING
+        landed = state == BatchGame.LANDED
+
+        # gravity while falling, all rows due at once
+        fall = falling & (events == GRAVITY)
+        sel = idx[fall]
+        if len(sel):
+            # the timer keeps the remainder _tick left, as in GameCore
+            rows = gravity_rows[fall]
+            # one row, the usual case below high levels, is a single test
+            y = np.zeros(len(sel), dtype=np.int64)
+            one = rows == 1
+            s = sel[one]
+            y[one] = self.fits(s, self.piece[s], self.which[s], self.x[s], self.y[s] + 1)
+            s = sel[~one]
+            if len(s):
+                y[~one] = np.minimum(self.landing_row(s) - self.y[s], rows[~one])
+            self.y[sel] += y.astype(self.y.dtype)
+            stuck = sel[y < rows]
+            self.gamestate[stuck] = BatchGame.LANDED
+            self.time_since_landed[stuck] = 0
+
+        # soft drop while falling
+        drop = falling & (events == DROP)
+        sel = idx[drop]
+        if len(sel):
+            self.time_since_last_gravity[sel] = 0
+            ok = self.fits(sel, self.piece[sel], self.which[sel], self.x[sel], self.y[sel] + 1)
+            self.y[sel[ok]] += 1
+            self.score[sel[ok & (events[drop] == DROP)]] += 1
+            stuck = sel[~ok]
+            self.gamestate[stuck] = BatchGame.LANDED
+            self.time_since_landed[stuck] = 0
+
+        sel = idx[falling & (events == HARDDROP)]
+        if len(sel):
+            y = self.landing_row(sel)
+            self.score[sel] += (y - self.y[sel]) * 2
+            self.y[sel] = y
+            self.gamestate[sel] = BatchGame.LOCKED
+
+        # landed pieces lock on drops and the lock timeout, other events may
+        # have moved them off the obstacle
+        lock = landed & np.isin(events, (DROP, HARDDROP, LOCKTIMEOUT))
+        self.gamestate[idx[lock]] = BatchGame.LOCKED
+        sel = idx[landed & ~lock]
+        if len(sel):
+            ok = self.fits(sel, self.piece[sel], self.which[sel], self.x[sel], self.y[sel] + 1)
+            self.gamestate[sel[ok]] = BatchGame.FALLING
+
+        sel = idx[self.gamestate[idx] == BatchGame.LOCKED]
+        if len(sel):
+            self._lock(sel)
+
+    def _rotate(self, sel, rot):
+        piece = self.piece[sel]
+        which = (self.which[sel] + rot) % 4
+        found = np.zeros(len(sel), dtype=bool)
+        dx = np.zeros(len(sel), dtype=np.int16)
+        dy = np.zeros(len(sel), dtype=np.int16)
+        kick_dx, kick_dy = KICK_DX[self.kick_sign], KICK_DY[self.kick_sign]
+        for k in range(KICK_VALID.shape[1]):
+            cand = np.flatnonzero(~found & KICK_VALID[piece, k])
+            if len(cand) == 0:
+                break
+            kx, ky = kick_dx[piece[cand], k], kick_dy[piece[cand], k]
+            s = sel[cand]
+            ok = self.fits(s, piece[cand], which[cand], self.x[s] + kx, self.y[s] + ky)
+            hit = cand[ok]
+            found[hit] = True
+            dx[hit], dy[hit] = kx[ok], ky[ok]
+        hit = sel[found]
+        self.which[hit] = which[found]
+        self.x[hit] += dx[found]
+        self.y[hit] += dy[found]
+        self.floor_kick[hit] = dy[found] == -1
+
+    def landing_row(self, sel):
+        # vectorized get_ghost_coords: the piece is tested against every
+        # position below it at once, it lands one row above the first one it
+        # collides with. The solid rows under the board stop every piece.
+        top = self.y[sel].astype(np.int64) + PAD_Y
+        shift = (self.x[sel].astype(np.int64) + PAD_X).astype(np.uint32)
+        shape = MASKS[self.piece[sel], self.which[sel] % 4] << shift[:, None]
+        windows = np.lib.stride_tricks.sliding_window_view(self.rows[sel], 4, axis=1)
+        hit = (windows & shape[:, None, :]).any(axis=2)
+        hit &= np.arange(hit.shape[1]) > top[:, None]
+        return (hit.argmax(axis=1) - 1 - PAD_Y).astype(self.y.dtype)
+
+    def _lock(self, sel):
+        # put_into_board
+        shift = (self.x[sel].astype(np.int64) + PAD_X).astype(np.uint32)
+        shape = MASKS[self.piece[sel], self.which[sel] % 4] << shift[:, None]
+        top = self.y[sel].astype(np.int64)[:, None] + PAD_Y + np.arange(4)
+        self.rows[sel[:, None], top] |= shape
+
+        # past_top
+        field = self.rows[sel, PAD_Y:PAD_Y + self.board_height] & self.field
+        over = (field[:, :2] != 0).any(axis=1)
+        self.gamestate[sel[over]] = BatchGame.GAMEOVER
+        sel, field = sel[~over], field[~over]
+        if len(sel) == 0:
+            return
+
+        # clear_rows: stable sort full rows to the top, then empty them
+        full = field == self.field
+        cleared = full.sum(axis=1)
+        order = np.argsort(~full, axis=1, kind="stable")
+        field = np.take_along_axis(field, order, axis=1)
+        field[np.arange(self.board_height) < cleared[:, None]] = 0
+        self.rows[sel, PAD_Y:PAD_Y + self.board_height] = field | self.wall
+
+        # add_score
+        self.score[sel] += self.level[sel] * np.asarray(self.scoring, dtype=np.int64)[cleared]
+        self.lines[sel] += cleared
+        self.level[sel] = np.maximum(self.level[sel], 1 + self.lines[sel] // self.lines_per_level)
+
+        self._spawn(sel)
+        self.spawned[sel] = True
+
+    def _spawn(self, sel):
+        # new_tetromino, plus the spawn collision check
+        self.piece[sel] = self.next_piece[sel]
+        self.next_piece[sel] = self.rng.integers(len(PIECES), size=len(sel))
+        self.which[sel] = 0
+        self.x[sel] = (self.board_width - SIZES[self.piece[sel]]) // 2
+        self.y[sel] = 0
+        self.floor_kick[sel] = False
+        self.time_since_last_gravity[sel] = 0
+        self.time_since_landed[sel] = 0
+        ok = self.fits(sel, self.piece[sel], self.which[sel], self.x[sel], self.y[sel])
+        self.gamestate[sel] = np.where(ok, BatchGame.FALLING, BatchGame.GAMEOVER)
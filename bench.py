@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+import ansi
+import core
+import tetromino
+
+
+# Benchmarks of the engine primitives and of whole frames. Every benchmark
+# runs on fixed seeds and fixed boards so results can be compared between
+# runs; --compare flags everything that got slower than a saved baseline.
+
+FIXTURES = ("empty", "half", "topped")
+
+INPUT_SCRIPT = "aadqe s w ddq sew  a"
+
+# seconds a fresh interpreter may take to import each module that headless
+# code (batch workers, the sweep, the server) starts from. None of them may
+# import urwid.
+STARTUP_BUDGET = {"core": 0.02, "bot": 0.05, "sweep": 0.05, "replay": 0.05, "app": 0.15}
+
+
+def make_game(fixture, seed=0):
+    # a game whose board is empty, half full or nearly topped out. Every
+    # filled row keeps one hole so nothing clears by accident.
+    game = core.GameCore(seed=seed)
+    rng = random.Random(seed)
+    first = {"empty": game.board_height, "half": game.board_height // 2, "topped": 4}[fixture]
+    board = tetromino.make_board(game.board_height, game.board_width)
+    for j in range(first, game.board_height):
+        hole = rng.randrange(game.board_width)
+        for i in range(game.board_width):
+            if i != hole and rng.random() < 0.8:
+                board[j][i] = rng.choice(tetromino.PIECE_NAMES)
+    game.board = tetromino.Bitboard.from_board(board)
+    return game
+
+
+def make_clearing_game(seed=0):
+    # bottom four rows full, as if the last piece completed them
+    game = make_game("half", seed)
+    for j in range(game.board_height - 4, game.board_height):
+        for i in range(game.board_width):
+            game.board.colors[j][i] = "I"
+    game.board = tetromino.Bitboard.from_board(game.board.colors)
+    game.rows_to_clear = list(range(game.board_height - 4, game.board_height))
+    return game
+
+
+def measure(fn, number, repeat=5):
+    # best time per call in seconds
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def play_state(fixture):
+    # a PlayGameState without a terminal, or None if urwid is missing
+    try:
+        import app
+    except ImportError:
+        return None
+    state = app.PlayGameState(app.StateStack(app.Context()))
+    state.core = make_game(fixture)
+    return state
+
+
+def bench_fixture(fixture, keep=lambda name: True):
+    # keep(name) says whether to run a benchmark, names as in bench_all
+    res = {}
+    def add(name, fn, number, calls=1):
+        if keep("{}[{}]".format(name, fixture)):
+            res[name] = measure(fn, number) / calls
+
+    game = make_game(fixture)
+    reference = game.board.colors
+    pieces = [tetromino.Tetromino(name, which) for name in tetromino.PIECE_NAMES for which in range(4)]
+    states = [tetromino.piece_state(t.name, t.which) for t in pieces]
+    positions = [(x, y) for x in range(0, game.board_width - 3) for y in range(0, game.board_height - 3)]
+
+    def run(check, board, pieces):
+        for t in pieces:
+            for x, y in positions:
+                check(board, t, x, y)
+    calls = len(pieces) * len(positions)
+
+    add("check_collision/reference", lambda: run(tetromino.check_collision, reference, pieces), 3, calls)
+    add("check_in_board/reference", lambda: run(tetromino.check_in_board, reference, pieces), 3, calls)
+    board = game.board
+    add("check_collision/bitboard", lambda: run(tetromino.Bitboard.check_collision, board, states), 3, calls)
+    add("check_in_board/bitboard", lambda: run(tetromino.Bitboard.check_in_board, board, states), 3, calls)
+
+    add("get_ghost_coords", game.get_ghost_coords, 2000)
+
+    add("snapshot", game.snapshot, 2000)
+    data = game.snapshot()
+    add("restore", lambda: core.GameCore.from_snapshot(data), 2000)
+    add("fork", game.fork, 2000)
+
+    screen = ansi.AnsiScreen(lambda data: None, game.board_width + 16, game.board_height + 3)
+    def ansi_frame(full):
+        if full:
+            screen.invalidate()
+        ansi.draw_game(screen, game)
+        screen.flush()
+    add("ansi frame/unchanged", lambda: ansi_frame(False), 200)
+    add("ansi frame/full", lambda: ansi_frame(True), 200)
+
+    def ticks():
+        g = make_game(fixture)
+        for n in range(600):
+            key = INPUT_SCRIPT[n % len(INPUT_SCRIPT)]
+            g.step([core.KEYMAP[key]] if key in core.KEYMAP else [])
+    add("core.step/600 ticks", ticks, 1)
+
+    if not (keep("render[{}]".format(fixture)) or keep("process+render/600 frames[{}]".format(fixture))):
+        return res
+    state = play_state(fixture)
+    if state is not None:
+        def render():
+            state.core.dirty = True
+            state.render(0)
+        add("render", render, 200)
+
+        def frames():
+            s = play_state(fixture)
+            for n in range(600):
+                key = INPUT_SCRIPT[n % len(INPUT_SCRIPT)]
+                s.handle_event(key)
+                s.process(s.core.step_size)
+                s.render(0)
+        add("process+render/600 frames", frames, 1)
+    return res
+
+
+def bench_large(width=200, height=2000, keep=lambda name: True):
+    # a board far larger than the stack on it, dense against sparse rows
+    res = {}
+    for sparse in (False, True):
+        label = "{}x{} {}".format(width, height, "sparse" if sparse else "dense")
+        names = ["{}[{}]".format(name, label) for name in
+                 ("core.step/600 ticks", "snapshot", "fork", "ansi frame/unchanged")]
+        if not any(keep(name) for name in names):
+            continue
+        def ticks():
+            g = core.GameCore(width, height, seed=0, sparse=sparse)
+            for n in range(600):
+                key = INPUT_SCRIPT[n % len(INPUT_SCRIPT)]
+                g.step([core.KEYMAP[key]] if key in core.KEYMAP else [])
+            return g
+        if keep(names[0]):
+            res[names[0]] = measure(ticks, 1)
+        game = ticks()
+        if keep(names[1]):
+            res[names[1]] = measure(game.snapshot, 20)
+        if keep(names[2]):
+            res[names[2]] = measure(game.fork, 20)
+        screen = ansi.AnsiScreen(lambda data: None, 80, 24)
+        view = ansi.Viewport(game, 46, 22)
+        def ansi_frame():
+            ansi.draw_game(screen, game, view=view)
+            screen.flush()
+        if keep(names[3]):
+            res[names[3]] = measure(ansi_frame, 50)
+    return res
+
+
+def bench_startup(repeat=5, keep=lambda name: True):
+    res = {}
+    code = ("import sys, time; start = time.perf_counter(); import {}; "
+            "print(time.perf_counter() - start, 'urwid' in sys.modules)")
+    for name in STARTUP_BUDGET:
+        if not keep("startup/import {}".format(name)):
+            continue
+        times = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", code.format(name)], capture_output=True, text=True,
+                                 check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+            if out[1] == "True":
+                raise Exception("Importing this module imports urwid: ", name)
+            times.append(float(out[0]))
+        res["startup/import {}".format(name)] = min(times)
+    return res
+
+
+def over_budget(results):
+    # names of the startup benchmarks over their budget
+    return [name for name, budget in STARTUP_BUDGET.items()
+            if results.get("startup/import {}".format(name), 0) > budget]
+
+
+def bench_all(names=None):
+    # only the benchmarks whose name contains one of names, all by default
+    def keep(name):
+        return not names or any(n in name for n in names)
+
+    res = {}
+    if keep("make_shape_template"):
+        # the build itself, the cache entry is dropped before every call
+        templates = [["    ", "xxxx", "    ", "    "], [" x ", "xxx", "   "]]
+        def build():
+            for t in templates:
+                tetromino.SHAPE_TEMPLATES.pop((tuple(t), 4), None)
+                tetromino.make_shape_template(t)
+        res["make_shape_template"] = measure(build, 200) / len(templates)
+
+    if keep("clear_rows"):
+        # the games are built by the setup, only clear_rows() is timed
+        games = []
+        def setup():
+            games[:] = [make_clearing_game() for _ in range(50)]
+        def clear():
+            games.pop().clear_rows()
+        res["clear_rows"] = min(timeit.repeat(clear, setup, number=50, repeat=5)) / 50
+
+    for fixture in FIXTURES:
+        for name, t in bench_fixture(fixture, keep).items():
+            res["{}[{}]".format(name, fixture)] = t
+    res.update(bench_large(keep=keep))
+    res.update(bench_startup(keep=keep))
+    return res
+
+
+def compare(results, baseline, threshold):
+    # names of benchmarks slower than baseline by more than threshold
+    slower = []
+    for name, t in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print("{:45} {:12.3f} us   (new)".format(name, t * 1e6))
+            continue
+        change = (t - base) / base if base else 0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            slower.append(name)
+        print("{:45} {:12.3f} us {:+8.1%}{}".format(name, t * 1e6, change, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the engine and the frame loop.")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown that counts as a regression, default 0.10")
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name contains one of these")
+    args = parser.parse_args()
+
+    results = bench_all(args.names)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"python": sys.version, "machine": platform.machine(),
+                       "time": time.time(), "results": results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print("{} regressions".format(len(slower)))
+            return 1
+    else:
+        for name, t in sorted(results.items()):
+            print("{:45} {:12.3f} us".format(name, t * 1e6))
+    over = over_budget(results)
+    if over:
+        print("over the startup budget: " + ", ".join(over))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import time
+import core
+import placements
+
+
+# Placement bot. Boards are scored with a linear heuristic over aggregate
+# height, completed lines, holes and bumpiness; with lookahead the known
+# next piece is placed on every candidate board too and the best pair wins.
+
+WEIGHTS = {"height": -0.510066,
+           "lines": 0.760666,
+           "holes": -0.35663,
+           "bumpiness": -0.184483}
+
+
+def evaluate(board, cleared, weights=WEIGHTS):
+    heights = [board.num_rows - top for top in board.tops]
+    aggregate = sum(heights)
+    # every filled cell is at or below its column top, the rest are holes
+    holes = aggregate - sum(board.counts)
+    bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+    return (weights["height"] * aggregate +
+            weights["lines"] * cleared +
+            weights["holes"] * holes +
+            weights["bumpiness"] * bumpiness)
+
+
+def spawn_x(board, piece):
+    # where core.GameCore.new_tetromino puts a new piece
+    return (board.num_cols - piece.width()) // 2
+
+
+def place(board, placement):
+    # board after locking the placement, the number of cleared rows, or
+    # None if the lock tops out
+    b = board.copy()
+    touched = b.put(placement.piece, placement.x, placement.y)
+    if b.counts[0] or b.counts[1]:
+        return None, 0
+    return b, b.clear_rows(touched)
+
+
+def search_subtrees(board, candidates, next_piece, weights, kick_sign=-1, deadline=None):
+    # best (value, index) over candidates, each one extended with every
+    # placement of next_piece. Returns the number of boards evaluated too.
+    # Past deadline (time.monotonic(), comparable between processes) the
+    # best so far is returned, the remaining candidates are not searched.
+    best, best_index, nodes = None, None, 0
+    for index, placement in candidates:
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        b, cleared = place(board, placement)
+        if b is None:
+            continue
+        nodes += 1
+        if next_piece is None:
+            value = evaluate(b, cleared, weights)
+        else:
+            x = spawn_x(b, next_piece)
+            if b.check_collision(next_piece, x, 0) is not None:
+                continue
+            value = None
+            for p2 in placements.reachable_placements(b, next_piece, x, 0, kick_sign=kick_sign):
+                b2, cleared2 = place(b, p2)
+                if b2 is None:
+                    continue
+                nodes += 1
+                v = evaluate(b2, cleared + cleared2, weights)
+                if value is None or v > value:
+                    value = v
+            if value is None:
+                continue
+        if best is None or value > best:
+            best, best_index = value, index
+    return best, best_index, nodes
+
+
+class Bot:
+    def __init__(self, weights=None, lookahead=True, workers=0, time_budget=None):
+        self.weights = WEIGHTS if weights is None else weights
+        self.lookahead = lookahead
+        self.time_budget = time_budget
+        self.workers = workers
+        self.pool = None
+        if workers:
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+        self.pieces = 0
+        self.nodes = 0
+        self.elapsed = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def stats(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return {"pieces": self.pieces,
+                "nodes": self.nodes,
+                "pieces_per_second": self.pieces / elapsed,
+                "nodes_per_second": self.nodes / elapsed}
+
+    def choose(self, game):
+        # best placement for the current piece of a core.GameCore, None when
+        # every placement tops out
+        start = time.perf_counter()
+        cands = placements.game_placements(game)
+        next_piece = game.next_piece if self.lookahead else None
+
+        # greedy answer first, so there is always something within budget
+        greedy = []
+        for index, placement in enumerate(cands):
+            b, cleared = place(game.board, placement)
+            if b is not None:
+                greedy.append((evaluate(b, cleared, self.weights), index))
+        greedy.sort(reverse=True)
+        nodes = len(greedy)
+        best_index = greedy[0][1] if greedy else None
+        if next_piece is not None and greedy:
+            # most promising subtrees first, they are searched if time runs out
+            order = [(index, cands[index]) for _, index in greedy]
+            res = self._search(game.board, order, next_piece, start, game.kick_sign)
+            nodes += res[2]
+            if res[1] is not None:
+                best_index = res[1]
+
+        self.pieces += 1
+        self.nodes += nodes
+        self.elapsed += time.perf_counter() - start
+        return None if best_index is None else cands[best_index]
+
+    def _search(self, board, cands, next_piece, start, kick_sign=-1):
+        # cands is a list of (index, placement). The budget is checked
+        # between subtrees, in the workers too.
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.monotonic() + self.time_budget - (time.perf_counter() - start)
+        if self.pool is None:
+            return search_subtrees(board, cands, next_piece, self.weights, kick_sign, deadline)
+
+        # spread the subtrees over the pool. Under a budget every worker
+        # gets one chunk and stops at the deadline with its best so far,
+        # else a few chunks per worker even out the load. Either way every
+        # task is done when the move is, none are left in the pool.
+        parts = self.workers if deadline is not None else self.workers * 2
+        chunks = [cands[i::parts] for i in range(parts)]
+        futures = [self.pool.submit(search_subtrees, board, chunk, next_piece, self.weights, kick_sign, deadline)
+                   for chunk in chunks if chunk]
+        # ties go to the earlier candidate, as in process
+        rank = {index: n for n, (index, _) in enumerate(cands)}
+        best, best_index, nodes = None, None, 0
+        for f in futures:
+            value, i, n = f.result()
+            nodes += n
+            if i is not None and (best is None or (value, -rank[i]) > (best, -rank[best_index])):
+                best, best_index = value, i
+        return best, best_index, nodes
+
+
+def play(game, bot, max_pieces=None, realtime=False):
+    # let the bot play a core.GameCore until game over. Moves are applied
+    # all in one tick, or with realtime one per tick like a player's keys,
+    # so gravity and the lock delay can get in the way.
+    pieces = 0
+    while game.gamestate is not core.GameCore.GAMEOVER:
+        if max_pieces is not None and pieces >= max_pieces:
+            break
+        placement = bot.choose(game)
+        moves = ["harddrop"] if placement is None else placement.moves
+        if realtime:
+            spawned = game.pieces
+            for move in moves:
+                game.step([move])
+                if game.pieces != spawned:
+                    # gravity locked the piece before the plan was done
+                    break
+        else:
+            game.step(moves)
+        pieces += 1
+    return game
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the placement bot headless.")
+    parser.add_argument("--games", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--max-pieces", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processes for the lookahead search, 0 searches in process")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="time budget per move in seconds")
+    parser.add_argument("--no-lookahead", action="store_true")
+    args = parser.parse_args()
+
+    bot = Bot(lookahead=not args.no_lookahead, workers=args.workers, time_budget=args.budget)
+    try:
+        for seed in range(args.seed, args.seed + args.games):
+            game = play(core.GameCore(seed=seed), bot, args.max_pieces)
+            print("seed {}: score {}, lines {}, level {}".format(seed, game.score, game.lines, game.level))
+    finally:
+        bot.close()
+    stats = bot.stats()
+    print("{pieces} pieces, {nodes} nodes, {pieces_per_second:.1f} pieces/s, "
+          "{nodes_per_second:.0f} nodes/s".format(**stats))
+
+
+if __name__ == "__main__":
+    main()
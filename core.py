@@ -0,0 +1,401 @@
+import copy
+import random
+import struct
+import tetromino
+
+
+# headless game rules, no urwid in here. Time advances in fixed ticks of
+# step_size seconds, input arrives as a list of action names per tick:
+# "left", "right", "rotate_left", "rotate_right", "drop", "harddrop"
+
+# keys understood by the game, anything else is not a game action
+KEYMAP = {"a": "left",
+          "d": "right",
+          "q": "rotate_left",
+          "e": "rotate_right",
+          "s": "drop",
+          "w": "harddrop"}
+
+
+# Snapshots are a fixed size header followed by the board rows that hold
+# anything, one byte per cell (see Bitboard.to_bytes). Pieces are stored as
+# 4 * index in PIECE_NAMES + rotation.
+SNAPSHOT = struct.Struct("<4sHHBQQQQIIIBBBBhhdddIdddIIIIIb")
+SNAPSHOT_MAGIC = b"TTS3"
+MASK64 = (1 << 64) - 1
+
+
+# points per piece for clearing 0 to 4 rows at once, times the level
+SCORING = (0, 40, 100, 300, 1200)
+
+
+class PieceRng:
+    # splitmix64, the whole state is one integer so it snapshots for free
+    def __init__(self, state):
+        self.state = state & MASK64
+
+    def next(self):
+        self.state = z = (self.state + 0x9E3779B97F4A7C15) & MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+        return z ^ (z >> 31)
+
+    def choice(self, seq):
+        return seq[self.next() % len(seq)]
+
+
+def piece_code(piece):
+    return 4 * tetromino.PIECE_NAMES.index(piece.name) + piece.which
+
+
+def code_piece(code):
+    return tetromino.piece_state(tetromino.PIECE_NAMES[code // 4], code % 4)
+
+
+class GameCore:
+    FALLING = 0
+    LANDED = 1
+    LOCKED = 2
+    CLEARING = 3
+    GAMEOVER = 4
+
+    def __init__(self, board_width=10, board_height=22, seed=None, step_size=1.0 / 60, sparse=False):
+        self.board_width = board_width
+        self.board_height = board_height
+        # sparse boards store only the rows under the stack, for boards far
+        # larger than the standard one
+        self.sparse = sparse
+        self.board = self.board_class()(self.board_height, self.board_width)
+        self.score = 0
+        self.level = 1
+        self.lines = 0
+        self.piece = None
+        self.next_piece = None
+
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed & MASK64
+        self.rng = PieceRng(self.seed)
+
+        self.step_size = step_size
+        self.tick = 0
+        # pieces spawned so far, the current one included
+        self.pieces = 0
+        # called as listener(event, *args) on "lock", "clear" (with the full
+        # rows), "spawn" and "restore", see spectate.py
+        self.listeners = []
+
+        self.new_tetromino()
+
+        self.dirty = True
+
+        self.gamestate = GameCore.FALLING
+
+        self.gravity_interval = 0.5 # seconds per row at level 1
+        self.time_since_last_gravity = 0
+        self.gravity_rows = 0
+        self.lines_per_level = 10
+        self.scoring = SCORING
+        # order of the rotation kicks, -1 tries left and up first, 1 right
+        # and down (see make_shape_template)
+        self.kick_sign = -1
+
+        self.lock_interval = self.gravity_interval
+        self.time_since_landed = 0
+
+        self.clear_effect = 1
+        self.time_since_locked = 0
+        self.rows_to_clear = []
+
+    def board_class(self):
+        return tetromino.SparseBitboard if self.sparse else tetromino.Bitboard
+
+    def snapshot(self):
+        # the complete game as bytes, restore() or from_snapshot() bring it back
+        header = SNAPSHOT.pack(SNAPSHOT_MAGIC, self.board_width, self.board_height, self.sparse,
+                               self.seed, self.rng.state, self.tick,
+                               self.score, self.level, self.lines, self.pieces,
+                               self.gamestate, piece_code(self.piece), piece_code(self.next_piece),
+                               self.floor_kick, self.x, self.y,
+                               self.time_since_last_gravity, self.time_since_landed,
+                               self.time_since_locked, self.gravity_rows,
+                               self.step_size, self.gravity_interval, self.lock_interval,
+                               self.lines_per_level, *self.scoring[1:], self.kick_sign)
+        return header + self.board.to_bytes()
+
+    def restore(self, data):
+        (magic, self.board_width, self.board_height, sparse,
+         self.seed, rng_state, self.tick,
+         self.score, self.level, self.lines, self.pieces,
+         self.gamestate, piece, next_piece,
+         floor_kick, self.x, self.y,
+         self.time_since_last_gravity, self.time_since_landed,
+         self.time_since_locked, self.gravity_rows,
+         self.step_size, self.gravity_interval, self.lock_interval,
+         self.lines_per_level, *scoring, self.kick_sign) = SNAPSHOT.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception("Not a game snapshot")
+        self.scoring = (0, *scoring)
+        self.sparse = bool(sparse)
+        self.rng = PieceRng(rng_state)
+        self.piece = code_piece(piece)
+        self.next_piece = code_piece(next_piece)
+        self.floor_kick = bool(floor_kick)
+        self.board = self.board_class().from_bytes(self.board_height, self.board_width,
+                                                   data[SNAPSHOT.size:])
+        self.clear_effect = 1
+        self.rows_to_clear = []
+        self.dirty = True
+        self.notify("restore")
+
+    @classmethod
+    def from_snapshot(cls, data):
+        game = cls.__new__(cls)
+        game.listeners = []
+        game.restore(data)
+        return game
+
+    def fork(self):
+        # an independent copy without the round trip through bytes
+        game = copy.copy(self)
+        game.board = self.board.copy()
+        game.rng = PieceRng(self.rng.state)
+        game.rows_to_clear = self.rows_to_clear[:]
+        game.listeners = []
+        return game
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def new_tetromino(self):
+        def random_tetromino():
+            return tetromino.piece_state(self.rng.choice(tetromino.PIECE_NAMES))
+
+        self.piece, self.next_piece = self.next_piece, random_tetromino()
+        self.pieces += 1
+        if self.piece is None:
+            self.piece = random_tetromino()
+
+        self.x = (self.board_width - self.piece.width()) // 2
+        self.y = 0
+        self.floor_kick = False
+        self.notify("spawn")
+
+    def step(self, actions=(), ticks=1):
+        # actions are applied on the first tick, the remaining ticks only
+        # advance the timers. With ticks=0 they are applied right away,
+        # between two ticks.
+        events = list(actions)
+        if ticks == 0:
+            if self.gamestate is not GameCore.GAMEOVER:
+                self.process_events(events)
+            return self.gamestate
+        for _ in range(ticks):
+            self._tick(events)
+            events = []
+        return self.gamestate
+
+    def _tick(self, events):
+        self.tick += 1
+        dt = self.step_size
+
+        # early exit
+        if self.gamestate is GameCore.GAMEOVER:
+            return
+
+        # update timed events, if needed add them to the event queue. All
+        # rows of gravity due this tick are one event, resolved in one go.
+        if self.gamestate in [GameCore.FALLING, GameCore.LANDED]:
+            self.time_since_last_gravity += dt
+            interval = self.gravity()
+            if self.time_since_last_gravity >= interval:
+                self.gravity_rows = int(self.time_since_last_gravity // interval)
+                events.append("gravity") # TO DO: insert at the correct time
+                self.time_since_last_gravity -= self.gravity_rows * interval
+
+        if self.gamestate is GameCore.LANDED:
+            self.time_since_landed += dt
+            if self.time_since_landed >= self.lock_interval:
+                events.append("locktimeout") # TO DO: insert at the correct time
+
+        self.process_events(events)
+
+    def process_events(self, events):
+        # process the events and change the state of the game
+        spawned = False
+        for event in events:
+            if spawned and event in ["gravity", "locktimeout"]:
+                # timed events of the piece that just locked
+                continue
+            if self.gamestate in [GameCore.FALLING, GameCore.LANDED]:
+                if event == "left":
+                    self.attempt_move_by(self.piece, -1, 0)
+
+                elif event == "right":
+                    self.attempt_move_by(self.piece, 1, 0)
+
+                elif event == "rotate_left":
+                    self.attempt_rotate(-1)
+
+                elif event == "rotate_right":
+                    self.attempt_rotate(1)
+
+            if self.gamestate is GameCore.FALLING:
+                if event == "drop":
+                    if not self.attempt_drop(event):
+                        self.gamestate = GameCore.LANDED
+                        self.time_since_landed = 0
+
+                elif event == "gravity":
+                    if not self.attempt_fall(self.gravity_rows):
+                        self.gamestate = GameCore.LANDED
+                        self.time_since_landed = 0
+
+                elif event == "harddrop":
+                    _, y = self.get_ghost_coords()
+                    self.score += (y - self.y) * 2
+                    self.y = y
+                    self.gamestate = GameCore.LOCKED
+
+            elif self.gamestate is GameCore.LANDED:
+                # gravity does not lock, so the lock delay holds at any speed
+                if event in ["drop", "harddrop", "locktimeout"]:
+                    self.gamestate = GameCore.LOCKED
+
+                elif self.test_move_by(self.piece, 0, 1): # did we move away from the obstacle?
+                    self.gamestate = GameCore.FALLING
+
+
+            if self.gamestate == GameCore.LOCKED:
+                self.put_into_board()
+                if self.past_top():
+                    self.gamestate = GameCore.GAMEOVER
+                    break
+                else:
+                    cleared = self.clear_rows()
+                    self.add_score(cleared)
+                    self.new_tetromino()
+                    self.time_since_last_gravity = 0
+                    spawned = True
+                    if self.board.check_collision(self.piece, self.x, self.y):  #FIXME
+                        self.gamestate = GameCore.GAMEOVER
+                    else:
+                        self.gamestate = GameCore.FALLING
+
+    def gravity(self):
+        # seconds per row at the current level, down to 20 rows per tick
+        # past level 115 the base goes negative, the floor is reached by 20
+        level = min(self.level - 1, 19)
+        interval = self.gravity_interval * (0.8 - level * 0.007) ** level
+        return max(interval, self.step_size / 20)
+
+    def time_to_next_event(self):
+        # seconds until gravity or the lock timer fires, None while nothing
+        # is timed (game over)
+        if self.gamestate in [GameCore.FALLING, GameCore.LANDED]:
+            t = self.gravity() - self.time_since_last_gravity
+            if self.gamestate is GameCore.LANDED:
+                t = min(t, self.lock_interval - self.time_since_landed)
+            return max(t, 0)
+        return None
+
+    def add_score(self, cleared):
+        self.score += self.level * self.scoring[cleared]
+        self.lines += cleared
+        self.level = max(self.level, 1 + self.lines // self.lines_per_level)
+
+
+    def test_move_by(self, piece, dx, dy):
+        crossed_borders = self.board.check_in_board(piece, self.x + dx, self.y + dy)
+        if crossed_borders is None:
+            collisions = self.board.check_collision(piece, self.x + dx, self.y + dy)
+            if collisions is None:
+                return True
+        return False
+
+
+    def attempt_move_by(self, piece, dx, dy):
+        if self.test_move_by(self.piece, dx, dy):
+            self.x += dx
+            self.y += dy
+            self.dirty = True
+            return True
+        return False
+
+
+    def test_rotate(self, rot):
+        rp = self.piece.rotate(rot)
+        for dx, dy in rp.kicks[self.kick_sign]:
+            if self.test_move_by(rp, dx, dy):
+                floor_kick = (dy == -1)
+                return dx, dy, floor_kick
+        return None
+
+
+    def attempt_rotate(self, rot):
+        res = self.test_rotate(rot)
+        if res is not None and not self.floor_kick:
+            dx, dy, self.floor_kick = res
+            self.piece = self.piece.rotate(rot)
+            self.x += dx
+            self.y += dy
+            self.dirty = True
+            return True
+        return False
+
+
+    def attempt_drop(self, event): # return True if dropped, False if landed
+        self.time_since_last_gravity = 0
+        if self.test_move_by(self.piece, 0, 1):
+            self.y += 1
+            if event == "drop":
+                self.score += 1
+            self.dirty = True
+            return True
+        else:
+            return False
+
+
+    def attempt_fall(self, rows): # return True if fell all rows, False if landed
+        # the timer keeps the remainder _tick left, so the speed follows the
+        # level curve between whole ticks
+        _, y = self.get_ghost_coords()
+        dy = min(rows, y - self.y)
+        if dy > 0:
+            self.y += dy
+            self.dirty = True
+        return dy == rows
+
+
+    def get_ghost_coords(self):
+        y = self.board.landing_row(self.piece, self.x, self.y)
+        if y is not None:
+            return self.x, y
+        dy = 0
+        while self.test_move_by(self.piece, 0, dy + 1):
+            dy += 1
+        return self.x, self.y + dy
+
+
+    def past_top(self):
+        board = self.board
+        return board.row_count(0) > 0 or board.row_count(1) > 0
+
+
+    def put_into_board(self):
+        self.rows_to_clear = self.board.put(self.piece, self.x, self.y)
+        self.dirty = True
+        self.notify("lock")
+
+
+    def clear_rows(self):
+        if self.listeners:
+            full = [j for j in self.rows_to_clear if self.board.row_full(j)]
+            if full:
+                self.notify("clear", full)
+        cleared = self.board.clear_rows(self.rows_to_clear)
+
+        self.dirty = True
+
+        return cleared
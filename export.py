@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import struct
+import time
+import numpy as np
+import bot
+import core
+import sweep
+
+
+# Training data from bot games: one fixed size record per placed piece with
+# the board before the piece, the piece, the next piece, the placement the
+# bot chose and the points add_score gave for it. Records go straight into
+# memory-mapped .npy shards of shard_size records, a new shard is started
+# when one is full, so memory does not grow with the number of records.
+# index.json, written when the writer is closed, lists the shards. Readers
+# map the shards with np.load(mmap_mode="r"), see open_shards().
+#
+# Board cells are 0 for empty, else 1 + index in PIECE_NAMES as in
+# Bitboard.to_bytes, pieces are 4 * index in PIECE_NAMES + rotation as in
+# snapshots.
+
+INDEX = "index.json"
+VERSION = 1
+
+
+def record_dtype(board_width=10, board_height=22):
+    return np.dtype([("board", np.uint8, (board_height, board_width)),
+                     ("piece", np.uint8),
+                     ("next_piece", np.uint8),
+                     ("x", np.int16),
+                     ("y", np.int16),
+                     ("rotation", np.uint8),
+                     ("reward", np.int32),
+                     ("lines", np.uint8),
+                     ("seed", np.uint64),
+                     ("ply", np.uint32)])
+
+
+class ShardWriter:
+    def __init__(self, directory, board_width=10, board_height=22, shard_size=65536):
+        self.directory = directory
+        self.board_width = board_width
+        self.board_height = board_height
+        self.dtype = record_dtype(board_width, board_height)
+        self.shard_size = shard_size
+        self.shards = []
+        self.shard = None
+        self.count = 0
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, board, piece, next_piece, placement, reward, lines, seed=0, ply=0):
+        # board is Bitboard.to_bytes() from before the piece was placed
+        if self.shard is None:
+            self._open_shard()
+        # the rows above the stack are left out of board, they are zero
+        cells = bytes(self.board_width * self.board_height - len(board)) + board
+        self.shard[self.count] = (np.frombuffer(cells, dtype=np.uint8).reshape(self.board_height, -1),
+                                  core.piece_code(piece), core.piece_code(next_piece),
+                                  placement.x, placement.y, placement.which, reward, lines, seed, ply)
+        self.count += 1
+        self.records += 1
+        if self.count == self.shard_size:
+            self._close_shard()
+
+    def close(self):
+        if self.shard is not None:
+            self._close_shard()
+        index = {"version": VERSION,
+                 "board_width": self.board_width,
+                 "board_height": self.board_height,
+                 "dtype": np.lib.format.dtype_to_descr(self.dtype),
+                 "records": self.records,
+                 "shards": self.shards}
+        with open(os.path.join(self.directory, INDEX), "w") as f:
+            json.dump(index, f, indent=1)
+
+    def _open_shard(self):
+        filename = "shard-{:05}.npy".format(len(self.shards))
+        self.filename = os.path.join(self.directory, filename)
+        self.shard = np.lib.format.open_memmap(self.filename, mode="w+", dtype=self.dtype,
+                                               shape=(self.shard_size,))
+        self.count = 0
+
+    def _close_shard(self):
+        self.shard.flush()
+        self.shard = None
+        if self.count < self.shard_size:
+            shrink_npy(self.filename, self.count)
+        self.shards.append({"file": os.path.basename(self.filename), "records": self.count})
+
+
+def shrink_npy(filename, length):
+    # cut a one-dimensional .npy file down to its first length records in
+    # place. The header is padded back to its old size, so the data stays
+    # where it is.
+    with open(filename, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        if len(shape) != 1:
+            raise Exception("Not a one-dimensional array: ", filename)
+        header = repr({"descr": np.lib.format.dtype_to_descr(dtype),
+                       "fortran_order": fortran_order,
+                       "shape": (length,)})
+        prefix = np.lib.format.magic(*version)
+        size = "<H" if version == (1, 0) else "<I"
+        header_len = offset - len(prefix) - struct.calcsize(size)
+        if len(header) + 1 > header_len:
+            raise Exception("Header does not fit: ", filename)
+        f.seek(0)
+        f.write(prefix + struct.pack(size, header_len) + (header.ljust(header_len - 1) + "\n").encode("latin1"))
+        f.truncate(offset + length * dtype.itemsize)
+
+
+def load_index(directory):
+    with open(os.path.join(directory, INDEX)) as f:
+        index = json.load(f)
+    if index.get("version") != VERSION:
+        raise Exception("Unknown export version: ", index.get("version"))
+    return index
+
+
+def open_shards(directory):
+    # every shard as a read-only memory map, nothing is read until used
+    return [np.load(os.path.join(directory, shard["file"]), mmap_mode="r")
+            for shard in load_index(directory)["shards"]]
+
+
+def export_game(writer, seed, player, max_pieces=None):
+    # plays one game with the bot, one record per placed piece
+    game = core.GameCore(writer.board_width, writer.board_height, seed=seed)
+    ply = 0
+    while game.gamestate is not core.GameCore.GAMEOVER:
+        if max_pieces is not None and ply >= max_pieces:
+            break
+        placement = player.choose(game)
+        if placement is None:
+            # every placement tops out
+            game.step(["harddrop"])
+            break
+        board = game.board.to_bytes()
+        piece, next_piece = game.piece, game.next_piece
+        level, lines = game.level, game.lines
+        game.step(placement.moves)
+        # the points add_score gave for the rows the piece cleared
+        cleared = game.lines - lines
+        writer.add(board, piece, next_piece, placement, level * game.scoring[cleared], cleared, seed, ply)
+        ply += 1
+    return ply
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export bot games as memory-mapped training data.")
+    parser.add_argument("--out", required=True, help="directory for the shards and " + INDEX)
+    parser.add_argument("--seeds", type=sweep.seed_range, default=sweep.seed_range("10"),
+                        help="N for seeds 0..N-1 or START:STOP, default 10")
+    parser.add_argument("--shard-size", type=int, default=65536, help="records per shard")
+    parser.add_argument("--max-pieces", type=int, default=1000, help="per game")
+    parser.add_argument("--board", metavar="WxH", default="10x22",
+                        type=lambda s: tuple(int(n) for n in s.lower().split("x")))
+    parser.add_argument("--lookahead", action="store_true", help="slower, stronger bot")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    player = bot.Bot(lookahead=args.lookahead)
+    with ShardWriter(args.out, *args.board, shard_size=args.shard_size) as writer:
+        for seed in args.seeds:
+            export_game(writer, seed, player, args.max_pieces)
+    print("{} records in {} shards in {:.1f}s".format(writer.records, len(writer.shards),
+                                                       time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
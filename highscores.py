@@ -0,0 +1,132 @@
+import json
+import os
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError: # no advisory locks on this platform, appends stay atomic
+    fcntl = None
+
+
+# Leaderboard on disk. Results are appended to <path>.log as JSON lines and
+# never rewritten. <path>.idx holds the best `capacity` results as fixed
+# size (score, log offset) records, sorted by score, plus how much of the
+# log it covers, so a top-N page reads the small index and seeks to only
+# the lines it shows. Writers serialize on an flock of <path>.lock.
+
+HEADER = struct.Struct("<8sQI")
+ENTRY = struct.Struct("<qQ")
+MAGIC = b"TTRSIDX1"
+
+
+class HighScoreStore:
+    def __init__(self, path, capacity=1000):
+        self.path = path
+        self.log_path = path + ".log"
+        self.index_path = path + ".idx"
+        self.lock_path = path + ".lock"
+        self.capacity = capacity
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _lock(self):
+        f = open(self.lock_path, "a")
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _read_index(self):
+        # (log bytes covered, [(score, offset)])
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0, []
+        magic, covered, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            return 0, []
+        entries = [ENTRY.unpack_from(data, HEADER.size + i * ENTRY.size) for i in range(count)]
+        return covered, entries
+
+    def _write_index(self, covered, entries):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, covered, len(entries)))
+            for score, offset in entries:
+                f.write(ENTRY.pack(score, offset))
+        os.replace(tmp, self.index_path)
+
+    def _insert(self, entries, score, offset):
+        # highest score first, the older result first on ties
+        lo, hi = 0, len(entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entries[mid][0] >= score:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.capacity:
+            entries.insert(lo, (score, offset))
+            del entries[self.capacity:]
+
+    def _catch_up(self, covered, entries):
+        # index results appended after `covered`, e.g. by a writer that died
+        # between appending and updating the index
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(covered)
+                for line in f:
+                    try:
+                        score = int(json.loads(line)["score"])
+                    except (ValueError, KeyError):
+                        covered += len(line)
+                        continue
+                    self._insert(entries, score, covered)
+                    covered += len(line)
+        except FileNotFoundError:
+            pass
+        return covered
+
+    def add(self, name, level, score, lines, replay=None, timestamp=None):
+        record = {"name": name, "level": level, "score": score, "lines": lines,
+                  "time": time.time() if timestamp is None else timestamp,
+                  "replay": replay}
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._lock():
+            covered, entries = self._read_index()
+            covered = self._catch_up(covered, entries)
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                offset = os.fstat(fd).st_size
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._insert(entries, score, offset)
+            self._write_index(offset + len(line), entries)
+
+    def page(self, start=0, count=10):
+        # results ranked start .. start + count - 1, best first, as dicts
+        # with their rank added. Only the best `capacity` results are ranked.
+        covered, entries = self._read_index()
+        try:
+            size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return []
+        if covered < size:
+            with self._lock():
+                covered, entries = self._read_index()
+                covered = self._catch_up(covered, entries)
+                self._write_index(covered, entries)
+
+        res = []
+        with open(self.log_path, "rb") as f:
+            for rank, (score, offset) in enumerate(entries[start:start + count], start + 1):
+                f.seek(offset)
+                record = json.loads(f.readline())
+                record["rank"] = rank
+                res.append(record)
+        return res
+
+    def __len__(self):
+        return len(self._read_index()[1])
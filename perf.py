@@ -0,0 +1,278 @@
+import collections
+import json
+import struct
+import time
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows, the pacer cannot ask the tty for its queue there
+    fcntl = None
+
+
+# Rolling frame statistics for Application.run. Every stat keeps the last
+# `window` samples, enough for percentiles, plus running totals.
+
+class RollingStat:
+    def __init__(self, window=600):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0,
+                "p50": self.percentile(50),
+                "p99": self.percentile(99),
+                "max": self.max}
+
+
+class InputLatency:
+    # every key is timestamped when it arrives and then at each stage it
+    # passes: handled by the state stack, processed by the game, written to
+    # the terminal. Latencies are kept per key, counted from arrival.
+    STAGES = ("handled", "processed", "written")
+
+    def __init__(self, window=600):
+        self.window = window
+        self.pending = []
+        self.stats = {}
+
+    def arrived(self, key, t):
+        self.pending.append((key, t, {}))
+
+    def mark(self, stage, t):
+        # keys that passed the previous stage reach this one
+        n = InputLatency.STAGES.index(stage)
+        before = InputLatency.STAGES[n - 1] if n else None
+        for key, arrived, stages in self.pending:
+            if stage not in stages and (before is None or before in stages):
+                stages[stage] = t
+        if stage == "written":
+            done = [p for p in self.pending if "written" in p[2]]
+            self.pending = [p for p in self.pending if "written" not in p[2]]
+            for key, arrived, stages in done:
+                per_key = self.stats.get(key)
+                if per_key is None:
+                    per_key = self.stats[key] = {s: RollingStat(self.window) for s in InputLatency.STAGES}
+                for s in InputLatency.STAGES:
+                    per_key[s].add(stages[s] - arrived)
+
+    def summary(self):
+        return {key: {s: stat.summary() for s, stat in per_key.items()}
+                for key, per_key in sorted(self.stats.items())}
+
+    def overlay_text(self):
+        written = [stat for per_key in self.stats.values() for stat in per_key["written"].samples]
+        written.sort()
+        if not written:
+            return "input -"
+        return "input {:.2f}/{:.2f}ms".format(1000 * written[len(written) // 2],
+                                              1000 * written[min(len(written) - 1, int(0.99 * len(written)))])
+
+
+# shorter names for the overlay
+OVERLAY_NAMES = {"handle_events": "events"}
+
+
+class FrameStats:
+    # times in seconds: frame is the work of one loop iteration, the others
+    # are its parts; steps counts fixed process steps per iteration, bytes
+    # the terminal output of every screen update
+    NAMES = ("frame", "handle_events", "process", "render", "draw", "steps", "bytes")
+
+    def __init__(self, window=600):
+        self.stats = {name: RollingStat(window) for name in FrameStats.NAMES}
+        self.dropped_frames = 0
+        self.visible = False
+        self.input = InputLatency(window)
+        self.pacer = None
+
+    def add(self, name, value):
+        self.stats[name].add(value)
+
+    def summary(self):
+        res = {name: stat.summary() for name, stat in self.stats.items()}
+        res["dropped_frames"] = self.dropped_frames
+        res["input_latency"] = self.input.summary()
+        if self.pacer is not None:
+            res["pacer"] = self.pacer.summary()
+        return res
+
+    def overlay_text(self, max_lines=None, width=None):
+        # one entry per stat, most wanted first. When there are more than
+        # max_lines they go into columns, as many as fit into width; what
+        # does not fit is left out.
+        entries = []
+        for name in ("frame", "render", "draw", "process", "handle_events"):
+            s = self.stats[name]
+            entries.append("{} {:.2f}/{:.2f}ms".format(OVERLAY_NAMES.get(name, name),
+                                                     1000 * s.percentile(50), 1000 * s.percentile(99)))
+        entries.append(self.input.overlay_text())
+        if self.pacer is not None:
+            entries.extend(self.pacer.overlay_text().split("\n"))
+        for name in ("steps", "bytes"):
+            s = self.stats[name]
+            entries.append("{} {:.0f}/{:.0f}".format(name, s.percentile(50), s.percentile(99)))
+        entries.append("dropped {}".format(self.dropped_frames))
+        if max_lines is None or len(entries) <= max_lines:
+            return "\n".join(entries)
+
+        max_lines = max(max_lines, 1)
+        column = max(len(e) for e in entries) + 2
+        columns = -(-len(entries) // max_lines)
+        if width is not None:
+            columns = max(1, min(columns, (width + 2) // column))
+        entries = entries[:columns * max_lines]
+        rows = -(-len(entries) // columns)
+        lines = []
+        for n in range(rows):
+            line = "".join(e.ljust(column) for e in entries[n::rows])
+            lines.append(line.rstrip())
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+class FramePacer:
+    # decides when the screen is drawn, the game keeps stepping at its fixed
+    # rate in between. Frames are at least 1 / max_fps apart, further when
+    # drawing takes long (it may take half the time at most) or when the
+    # terminal reads a frame's bytes slower than that. The frames held back
+    # are merged, the next one drawn shows the latest state.
+    #
+    # The terminal is behind when writing to it blocked, or, where the tty
+    # tells (not on ptys), while it still has output queued. Its throughput
+    # is measured then, frames are spaced so it gets a little ahead again.
+    def __init__(self, output=None, max_fps=60, min_fps=4):
+        self.output = output
+        self.min_interval = 1.0 / max_fps
+        self.max_interval = 1.0 / min_fps
+        self.interval = self.min_interval
+        self.next_frame = 0
+        self.pending = False
+        self.frames = 0
+        self.merged = 0
+        self.blocked_frames = 0
+        # moving averages of the last few frames
+        self.draw_time = 0
+        self.frame_bytes = 0
+        # bytes per second the terminal reads, None until it was behind once
+        self.throughput = None
+        self.backed_up = False
+        self.last_blocked = False
+        # time the terminal needs per frame, while it is the bottleneck
+        self.link_interval = 0
+        self.frame_start = 0
+        self.cpu_start = 0
+        self.frame_end = 0
+        self.queued_after = 0
+
+    def queued(self):
+        # bytes written to the terminal that it has not read yet, 0 when
+        # that cannot be told
+        if fcntl is None:
+            return 0
+        try:
+            data = fcntl.ioctl(self.output.fileno(), termios.TIOCOUTQ, b"\0" * 4)
+            return struct.unpack("i", data)[0]
+        except (AttributeError, OSError, ValueError):
+            return 0
+
+    def due(self, now):
+        # True when a frame should be drawn now, call drawn() after it.
+        # Else it is held back and pending.
+        if now >= self.next_frame:
+            queued = self.queued()
+            if queued and self.queued_after > queued and now > self.frame_end:
+                self.add_throughput((self.queued_after - queued) / (now - self.frame_end))
+            if not queued:
+                self.frame_start = now
+                self.cpu_start = time.process_time()
+                return True
+            # wait for the terminal to catch up
+            self.backed_up = True
+            wait = queued / self.throughput if self.throughput else self.min_interval
+            self.next_frame = now + min(wait, self.max_interval)
+        self.pending = True
+        self.merged += 1
+        return False
+
+    def drawn(self, written):
+        # the frame due() allowed is out, written bytes long
+        end = time.perf_counter()
+        wall = end - self.frame_start
+        cpu = time.process_time() - self.cpu_start
+        self.frames += 1
+        self.pending = False
+        self.draw_time = 0.8 * self.draw_time + 0.2 * min(cpu, wall)
+        self.frame_bytes = 0.8 * self.frame_bytes + 0.2 * written
+        blocked = written and wall - cpu > 0.002
+        if blocked:
+            # the write waited for the terminal to read. When the last one
+            # did too, the terminal was busy since, with a full buffer
+            self.blocked_frames += 1
+            self.backed_up = True
+            if self.last_blocked:
+                self.add_throughput(written / (end - self.frame_end))
+            else:
+                self.add_throughput(written / wall)
+        self.last_blocked = blocked
+        if self.throughput and self.backed_up:
+            # a quarter slower than the terminal, so its backlog drains
+            self.link_interval = 1.25 * self.frame_bytes / self.throughput
+        else:
+            # a little faster again while the terminal keeps up
+            self.link_interval *= 0.9
+        self.backed_up = False
+        interval = max(self.min_interval, 2 * self.draw_time, self.link_interval)
+        self.interval = min(interval, self.max_interval)
+        self.next_frame = self.frame_start + self.interval
+        self.frame_end = end
+        self.queued_after = self.queued()
+
+    def add_throughput(self, rate):
+        self.throughput = rate if self.throughput is None else 0.8 * self.throughput + 0.2 * rate
+
+    def summary(self):
+        return {"frames": self.frames,
+                "merged": self.merged,
+                "blocked_frames": self.blocked_frames,
+                "fps": 1 / self.interval,
+                "draw_time": self.draw_time,
+                "frame_bytes": self.frame_bytes,
+                "throughput": self.throughput}
+
+    def overlay_text(self):
+        rate = "-" if self.throughput is None else "{:.0f}kB/s".format(self.throughput / 1000)
+        return "fps {:.0f} merged {}\ntty {}".format(1 / self.interval, self.merged, rate)
+
+
+class CountingOutput:
+    # wraps the terminal output stream and counts the bytes written to it
+    def __init__(self, f):
+        self.f = f
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data.encode("utf-8"))
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
@@ -0,0 +1,93 @@
+import collections
+
+
+# Every final resting position a piece can reach on a board, found with a
+# breadth-first search over (piece, x, y, floor_kick) states using the same
+# movement, kick and floor kick rules as core.GameCore. Moves are core action
+# names; each move list ends with "harddrop" so it locks the piece when
+# applied, e.g. all at once with GameCore.step(placement.moves).
+
+Placement = collections.namedtuple("Placement", "x y which piece moves")
+
+
+class PlacementSearch:
+    def __init__(self, board, kick_sign=-1):
+        self.board = board
+        self.kick_sign = kick_sign
+        self._fits = {}
+        self.collision_tests = 0
+
+    def fits(self, piece, x, y):
+        # every (piece, x, y) is tested against the board at most once
+        key = (piece, x, y)
+        res = self._fits.get(key)
+        if res is None:
+            self.collision_tests += 1
+            res = (self.board.check_in_board(piece, x, y) is None and
+                   self.board.check_collision(piece, x, y) is None)
+            self._fits[key] = res
+        return res
+
+    def rotate(self, piece, x, y, rot):
+        # mirrors GameCore.test_rotate
+        rp = piece.rotate(rot)
+        for dx, dy in rp.kicks[self.kick_sign]:
+            if self.fits(rp, x + dx, y + dy):
+                return rp, x + dx, y + dy, dy == -1
+        return None
+
+    def neighbours(self, state):
+        piece, x, y, floor_kick = state
+        if self.fits(piece, x - 1, y):
+            yield "left", (piece, x - 1, y, floor_kick)
+        if self.fits(piece, x + 1, y):
+            yield "right", (piece, x + 1, y, floor_kick)
+        if not floor_kick:
+            for move, rot in (("rotate_left", -1), ("rotate_right", 1)):
+                res = self.rotate(piece, x, y, rot)
+                if res is not None:
+                    yield move, res
+        if self.fits(piece, x, y + 1):
+            yield "drop", (piece, x, y + 1, floor_kick)
+
+    def search(self, piece, x, y, floor_kick=False):
+        start = (piece, x, y, floor_kick)
+        parents = {start: None}
+        queue = collections.deque([start])
+        found = {}
+        while queue:
+            state = queue.popleft()
+            piece, x, y, _ = state
+            if not self.fits(piece, x, y + 1):
+                # BFS order, so the first path to a resting spot is the shortest
+                key = (x, y, piece.which)
+                if key not in found:
+                    found[key] = state
+            for move, nxt in self.neighbours(state):
+                if nxt not in parents:
+                    parents[nxt] = (state, move)
+                    queue.append(nxt)
+
+        res = []
+        for (x, y, which), state in found.items():
+            moves = []
+            s = state
+            while parents[s] is not None:
+                s, move = parents[s]
+                moves.append(move)
+            moves.reverse()
+            # the trailing straight drop becomes a hard drop, which also locks
+            while moves and moves[-1] == "drop":
+                moves.pop()
+            moves.append("harddrop")
+            res.append(Placement(x, y, which, state[0], moves))
+        return res
+
+
+def reachable_placements(board, piece, x, y, floor_kick=False, kick_sign=-1):
+    return PlacementSearch(board, kick_sign).search(piece, x, y, floor_kick)
+
+
+def game_placements(game):
+    # placements for the current piece of a core.GameCore
+    return reachable_placements(game.board, game.piece, game.x, game.y, game.floor_kick, game.kick_sign)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import time
+import core
+
+
+# Input logs are JSON lines: a header with the RNG seed, one [tick, key] line
+# per key delivered to the game, and an "end" line written at game over.
+# tick is the number of core ticks completed before the key was applied.
+# With "immediate_input" in the header keys were applied as soon as they
+# arrived, between ticks, instead of together with the next tick.
+
+# version 2: pieces come from core.PieceRng instead of random.Random
+VERSION = 2
+
+
+class Recorder:
+    def __init__(self, filename, game, immediate_input=False):
+        self.filename = filename
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.f = open(filename, "w")
+        self._write({"version": VERSION, "seed": game.seed,
+                     "board_width": game.board_width,
+                     "board_height": game.board_height,
+                     "step_size": game.step_size,
+                     "sparse": game.sparse,
+                     "immediate_input": immediate_input})
+
+    def _write(self, obj):
+        self.f.write(json.dumps(obj))
+        self.f.write("\n")
+        self.f.flush()
+
+    def record(self, tick, key):
+        self._write([tick, key])
+
+    def finish(self, game):
+        if self.f is not None:
+            self._write({"end": game.tick, "score": game.score,
+                         "lines": game.lines, "level": game.level})
+            self.f.close()
+            self.f = None
+
+
+class InputLog:
+    def __init__(self, header, events, end=None):
+        self.header = header
+        self.events = events
+        self.end = end
+
+    @classmethod
+    def load(cls, filename):
+        header, events, end = None, [], None
+        with open(filename) as f:
+            for line in f:
+                obj = json.loads(line)
+                if header is None:
+                    header = obj
+                elif isinstance(obj, list):
+                    events.append((obj[0], obj[1]))
+                else:
+                    end = obj
+        if header is None or header.get("version") != VERSION:
+            raise Exception("Not a replay file: ", filename)
+        return cls(header, events, end)
+
+
+def replay(log, max_ticks=None):
+    # feed the log through the core as fast as possible, no rendering and no
+    # sleeping. Without an end marker the game runs until it is over.
+    game = core.GameCore(board_width=log.header["board_width"],
+                         board_height=log.header["board_height"],
+                         seed=log.header["seed"],
+                         step_size=log.header["step_size"],
+                         sparse=log.header.get("sparse", False))
+    if max_ticks is None:
+        max_ticks = log.end["end"] if log.end is not None else float("inf")
+    immediate = log.header.get("immediate_input", False)
+
+    events = iter(log.events)
+    pending = next(events, None)
+    while game.gamestate is not core.GameCore.GAMEOVER:
+        actions = []
+        while pending is not None and pending[0] <= game.tick:
+            action = core.KEYMAP.get(pending[1])
+            if action is not None:
+                actions.append(action)
+            pending = next(events, None)
+        # immediate keys of the last tick still apply, a hard drop there
+        # may be what ended the game
+        if immediate:
+            game.step(actions, 0)
+            actions = []
+        if game.tick >= max_ticks or game.gamestate is core.GameCore.GAMEOVER:
+            break
+        game.step(actions)
+    return game
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded games headless.")
+    parser.add_argument("logs", nargs="+", help="input logs written with app.py --record")
+    args = parser.parse_args()
+
+    failed = 0
+    for filename in args.logs:
+        log = InputLog.load(filename)
+        start = time.perf_counter()
+        game = replay(log)
+        elapsed = time.perf_counter() - start
+        result = {"score": game.score, "lines": game.lines, "level": game.level}
+        status = ""
+        if log.end is not None:
+            expected = {k: log.end[k] for k in result}
+            if expected != result:
+                status = " MISMATCH, recorded {}".format(expected)
+                failed += 1
+        print("{}: {} ticks, score {score}, lines {lines}, level {level}, "
+              "{:.0f} ticks/s{}".format(filename, game.tick, game.tick / max(elapsed, 1e-9),
+                                        status, **result))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+import ansi
+import app
+import core
+import spectate
+
+
+# Many games in one process: every TCP (telnet) connection gets its own
+# StateStack and game, drawn as plain ANSI text on the connection. All
+# sessions are advanced together by one fixed-timestep tick. Spectators
+# connect to a second port, send a session number (or an empty line for the
+# newest game) and get its spectate.py stream.
+
+IAC, SB, SE, WILL, WONT, DO, DONT = 255, 250, 240, 251, 252, 253, 254
+ECHO, SGA = 1, 3
+
+ARROWS = {"A": "e", "B": "s", "C": "d", "D": "a"}
+
+
+class RemotePlayState(app.AppState):
+    def __init__(self, statestack, seed=None):
+        super().__init__(statestack)
+        self.core = core.GameCore(seed=seed)
+        self.events = []
+        game = self.core
+        self.screen = ansi.AnsiScreen(self.context.screen.write, game.board_width + 16, game.board_height + 3)
+        self.context.screen.ansi_screen = self.screen
+        if self.context.broadcast is not None:
+            self.context.broadcast.attach(game)
+
+    def handle_event(self, event):
+        if self.core.gamestate is core.GameCore.GAMEOVER:
+            if event == "r":
+                self.gamestatestack.request_pop()
+                self.gamestatestack.request_push(RemotePlayState)
+        elif event in core.KEYMAP:
+            self.events.append(core.KEYMAP[event])
+        return True
+
+    def next_deadline(self):
+        if self.events:
+            return 0
+        return self.core.time_to_next_event()
+
+    def process(self, dt):
+        self.core.step(self.events)
+        self.events.clear()
+        return True
+
+    def render(self, alpha):
+        game = self.core
+        if game.dirty:
+            # only the changed cells go out, a new game repaints everything
+            ansi.draw_game(self.screen, game)
+            if game.gamestate is core.GameCore.GAMEOVER:
+                self.screen.text(0, game.board_height + 2, "r: play again, Q: quit")
+            self.screen.flush()
+            game.dirty = False
+        return True
+
+
+class ConnectionScreen:
+    # screen backend of one session, writes straight to the socket
+    def __init__(self, writer, max_buffer=64 * 1024):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.bytes_written = 0
+        # the AnsiScreen of the current game, for its frame stats
+        self.ansi_screen = None
+
+    def backed_up(self):
+        return self.writer.transport.get_write_buffer_size() > self.max_buffer
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.bytes_written += len(data)
+        self.writer.write(data)
+
+
+class Session:
+    def __init__(self, server, reader, writer, start_state=RemotePlayState, number=0):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.number = number
+        self.broadcast = spectate.Broadcaster()
+        self.context = app.Context()
+        self.context.loop = asyncio.get_running_loop()
+        self.context.screen = ConnectionScreen(writer)
+        self.context.broadcast = self.broadcast
+        self.gamestatestack = app.StateStack(self.context)
+        self.gamestatestack.request_push(start_state)
+        self.gamestatestack.apply_pending()
+        self.events = []
+        self.done = False
+        self.cpu_time = 0
+        self.ticks = 0
+
+    def feed(self, data):
+        # strip telnet commands, turn the rest into urwid style key names
+        i = 0
+        while i < len(data):
+            b = data[i]
+            if b == IAC and i + 1 < len(data):
+                cmd = data[i + 1]
+                if cmd == IAC:
+                    i += 2
+                elif cmd in (WILL, WONT, DO, DONT):
+                    i += 3
+                elif cmd == SB:
+                    end = data.find(bytes((IAC, SE)), i)
+                    i = len(data) if end < 0 else end + 2
+                else:
+                    i += 2
+                continue
+            if b == 0x1b:
+                if data[i + 1:i + 2] == b"[" and i + 2 < len(data):
+                    key = ARROWS.get(chr(data[i + 2]))
+                    if key is not None:
+                        self.events.append(key)
+                    i += 3
+                    continue
+                self.events.append("esc")
+            elif 32 <= b < 127:
+                self.events.append(chr(b))
+            i += 1
+
+    def handle_events(self):
+        for e in self.events:
+            if e == "Q":
+                self.close()
+            self.gamestatestack.handle_event(e)
+        self.events.clear()
+
+    def process(self, dt):
+        start = time.process_time()
+        self.handle_events()
+        self.gamestatestack.process(dt)
+        self.broadcast.flush()
+        if self.gamestatestack.is_empty():
+            self.close()
+        self.cpu_time += time.process_time() - start
+        self.ticks += 1
+
+    def render(self, alpha):
+        # a slow connection skips frames instead of queueing them
+        if not self.done and not self.context.screen.backed_up():
+            start = time.process_time()
+            self.gamestatestack.render(alpha)
+            self.cpu_time += time.process_time() - start
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            self.writer.close()
+            self.broadcast.close()
+
+
+class GameServer:
+    def __init__(self, step_size=1.0 / 60, measure_memory=False):
+        self.step_size = step_size
+        self.sessions = []
+        self.done = False
+        self.measure_memory = measure_memory
+        self.session_memory = []
+        self.tick_times = []
+        self.ticks = 0
+        self.sessions_started = 0
+
+    async def handle_connection(self, reader, writer):
+        before = tracemalloc.get_traced_memory()[0] if self.measure_memory else 0
+        # WILL ECHO stops local echo on the client, WILL SGA its line buffering
+        writer.write(bytes((IAC, WILL, ECHO, IAC, WILL, SGA)) + b"\x1b[2J\x1b[?25l")
+        self.sessions_started += 1
+        session = Session(self, reader, writer, number=self.sessions_started)
+        if self.measure_memory:
+            self.session_memory.append(tracemalloc.get_traced_memory()[0] - before)
+        self.sessions.append(session)
+        try:
+            while not session.done:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                session.feed(data)
+        except ConnectionError:
+            pass
+        finally:
+            session.close()
+
+    async def handle_spectator(self, reader, writer):
+        try:
+            line = (await reader.readline()).strip()
+        except ConnectionError:
+            writer.close()
+            return
+        sessions = [s for s in self.sessions if not s.done]
+        if line:
+            sessions = [s for s in sessions if str(s.number) == line.decode("ascii", "replace")]
+        if not sessions:
+            writer.close()
+            return
+        await sessions[-1].broadcast.subscribe(writer).run()
+
+    def stats(self):
+        active = len(self.sessions)
+        times = sorted(self.tick_times)
+        res = {"sessions": active,
+               "ticks": self.ticks,
+               "tick_ms_mean": 1000 * sum(times) / len(times) if times else 0,
+               "tick_ms_max": 1000 * times[-1] if times else 0,
+               "tick_us_per_session": 1e6 * sum(times) / len(times) / active if times and active else 0}
+        if self.session_memory:
+            res["session_bytes_mean"] = sum(self.session_memory) / len(self.session_memory)
+        screens = [s.context.screen.ansi_screen.stats() for s in self.sessions
+                   if s.context.screen.ansi_screen is not None]
+        frames = sum(screen["frame_bytes"]["count"] for screen in screens)
+        if frames:
+            # per screen update, over all sessions
+            res["frame_bytes_mean"] = sum(screen["frame_bytes"]["mean"] * screen["frame_bytes"]["count"]
+                                          for screen in screens) / frames
+            res["frame_bytes_max"] = max(screen["frame_bytes"]["max"] for screen in screens)
+            res["flush_us_mean"] = 1e6 * sum(screen["flush_time"]["mean"] * screen["flush_time"]["count"]
+                                             for screen in screens) / frames
+            res["flush_us_max"] = 1e6 * max(screen["flush_time"]["max"] for screen in screens)
+        spectators = [sub for s in self.sessions for sub in s.broadcast.stats()]
+        if spectators:
+            res["spectators"] = len(spectators)
+            res["spectator_bytes_per_second_mean"] = sum(sub["bytes_per_second"] for sub in spectators) / len(spectators)
+            res["spectator_bytes_per_second_max"] = max(sub["bytes_per_second"] for sub in spectators)
+            res["spectator_queue_drops"] = sum(sub["dropped"] for sub in spectators)
+        return res
+
+    async def run(self):
+        # the same fixed timestep loop as Application.run, shared by all
+        # sessions
+        max_frame_time = 1.0 / 5
+        step_size = self.step_size
+        prev_time = time.perf_counter()
+        while not self.done:
+            now = time.perf_counter()
+            if now - prev_time > max_frame_time:
+                prev_time = now - step_size
+            while now - prev_time >= step_size:
+                start = time.process_time()
+                for session in self.sessions:
+                    session.process(step_size)
+                self.tick_times.append(time.process_time() - start)
+                del self.tick_times[:-600]
+                self.ticks += 1
+                prev_time += step_size
+            self.sessions = [s for s in self.sessions if not s.done]
+            for session in self.sessions:
+                session.render((now - prev_time) / step_size)
+            await asyncio.sleep(max(0, prev_time + step_size - time.perf_counter()))
+
+    def stop(self):
+        self.done = True
+        for session in self.sessions:
+            session.close()
+
+
+async def run_client(host, port, duration, keys_per_second=8, seed=None):
+    # stands in for a player: random game keys, output read and dropped
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    received = 0
+
+    async def drain():
+        nonlocal received
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+
+    drainer = asyncio.ensure_future(drain())
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end and not drainer.done():
+        writer.write(rng.choice("adqesw" if rng.random() < 0.95 else "r").encode())
+        await asyncio.sleep(rng.expovariate(keys_per_second))
+    writer.write(b"Q")
+    writer.close()
+    drainer.cancel()
+    return received
+
+
+def same_game(a, b):
+    # what a spectator can know of a game: board, pieces, score, game over
+    return (a.board.to_bytes() == b.board.to_bytes() and
+            (a.piece, a.next_piece, a.x, a.y) == (b.piece, b.next_piece, b.x, b.y) and
+            (a.score, a.lines, a.level) == (b.score, b.lines, b.level) and
+            (a.gamestate is core.GameCore.GAMEOVER) == (b.gamestate is core.GameCore.GAMEOVER))
+
+
+async def run_spectator(host, port, duration, session="", server=None):
+    # stands in for a viewer, returns the bytes received, and how often the
+    # game rebuilt from the stream was compared with the session's and
+    # matched. That needs server, in this process, and is done whenever
+    # everything it sent has arrived; sessions only change on ticks, which
+    # are flushed to spectators at once.
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write("{}\n".format(session).encode())
+    local = writer.get_extra_info("sockname")
+    spectator = spectate.Spectator()
+    received = checks = matches = 0
+    end = time.perf_counter() + duration
+    try:
+        while time.perf_counter() < end:
+            try:
+                data = await asyncio.wait_for(reader.read(65536), end - time.perf_counter())
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            received += len(data)
+            spectator.feed(data)
+            if server is None or spectator.game is None:
+                continue
+            for s in server.sessions:
+                for sub in s.broadcast.subscribers:
+                    if sub.writer.get_extra_info("peername") != local:
+                        continue
+                    if not sub.queue and not sub.needs_keyframe and sub.bytes_sent == received:
+                        checks += 1
+                        matches += same_game(spectator.game, s.broadcast.game)
+    finally:
+        writer.close()
+    return received, checks, matches
+
+
+async def main_async(args):
+    if args.measure_memory:
+        tracemalloc.start()
+    server = GameServer(measure_memory=args.measure_memory)
+    tcp = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    port = tcp.sockets[0].getsockname()[1]
+    spectate_tcp = await asyncio.start_server(server.handle_spectator, args.host, args.spectate_port)
+    spectate_port = spectate_tcp.sockets[0].getsockname()[1]
+    print("Serving on {}:{}, spectators on port {}".format(args.host, port, spectate_port))
+    ticker = asyncio.ensure_future(server.run())
+    try:
+        if args.clients:
+            clients = [run_client(args.host, port, args.duration, seed=i) for i in range(args.clients)]
+            clients = asyncio.gather(*clients)
+            # viewers join once the games are running, spread over them
+            await asyncio.sleep(min(1.0, args.duration / 4))
+            spectators = [run_spectator(args.host, spectate_port, args.duration / 2, 1 + i % args.clients, server)
+                          for i in range(args.spectators)]
+            spectators = asyncio.gather(*spectators)
+            await asyncio.sleep(args.duration / 4)
+            print(server.stats())
+            received = await clients
+            print("{} clients received {} bytes".format(len(received), sum(received)))
+            watched = await spectators
+            if watched:
+                print("{} spectators received {} bytes, {:.0f} bytes/s each".format(
+                    len(watched), sum(n for n, _, _ in watched),
+                    sum(n for n, _, _ in watched) / len(watched) / (args.duration / 2)))
+                print("{} of {} comparisons with the server's games matched, {} spectators never "
+                      "compared".format(sum(m for _, _, m in watched), sum(c for _, c, _ in watched),
+                                        sum(not c for _, c, _ in watched)))
+        else:
+            while True:
+                await asyncio.sleep(10)
+                print(server.stats())
+    finally:
+        server.stop()
+        tcp.close()
+        spectate_tcp.close()
+        ticker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host many telnet games in one process.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777, help="0 picks a free port")
+    parser.add_argument("--spectate-port", type=int, default=7778, help="for spectate.py, 0 picks a free port")
+    parser.add_argument("--clients", type=int, default=0,
+                        help="run this many local test clients, then exit")
+    parser.add_argument("--spectators", type=int, default=0,
+                        help="with --clients, this many local test spectators watch the games")
+    parser.add_argument("--duration", type=float, default=10.0, help="test client run time in seconds")
+    parser.add_argument("--measure-memory", action="store_true",
+                        help="trace allocations to report memory per session")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
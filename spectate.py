@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import collections
+import struct
+import sys
+import time
+import ansi
+import core
+
+
+# Spectator stream of a live game. Instead of a rendered screen, viewers
+# get what changed, a few bytes per tick, and keep their own copy of the
+# game to draw from:
+#
+#   K len snapshot      keyframe, the whole game (GameCore.snapshot)
+#   M piece x y         the falling piece moved or rotated
+#   L                   the piece was put into the board where it is
+#   C n row...          full rows removed from the board
+#   S score lines level
+#   N piece next x y    a new piece spawned
+#   G                   game over
+#
+# Pieces are codes as in snapshots. Moves and score changes are sent once
+# per tick, at most, when the tick ends; locks, clears and spawns as they
+# happen, since the board depends on the piece position at that moment.
+# A keyframe goes out every keyframe_interval ticks and to every new
+# subscriber, so late joiners sync.
+
+KEYFRAME = struct.Struct("<cI")
+MOVE = struct.Struct("<cBhh")
+CLEAR = struct.Struct("<cB")
+ROW = struct.Struct("<H")
+SCORE = struct.Struct("<cQII")
+SPAWN = struct.Struct("<cBBhh")
+LOCK = b"L"
+GAMEOVER = b"G"
+
+
+class Subscriber:
+    # one viewer. The game never waits for it: chunks are queued up to
+    # max_queue bytes, a viewer that falls further behind loses its queue
+    # and is sent a keyframe instead.
+    def __init__(self, writer, max_queue=64 * 1024):
+        self.writer = writer
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.queued = 0
+        self.wakeup = asyncio.Event()
+        self.needs_keyframe = True
+        self.closed = False
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.start = time.perf_counter()
+
+    def send(self, data):
+        # False when the queue was full, it is dropped then
+        if self.queued + len(data) > self.max_queue:
+            self.queue.clear()
+            self.queued = 0
+            self.dropped += 1
+            return False
+        self.queue.append(data)
+        self.queued += len(data)
+        self.wakeup.set()
+        return True
+
+    async def run(self):
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue:
+                    data = self.queue.popleft()
+                    self.queued -= len(data)
+                    self.writer.write(data)
+                    self.bytes_sent += len(data)
+                    await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.wakeup.set()
+            self.writer.close()
+
+    def bytes_per_second(self):
+        return self.bytes_sent / max(time.perf_counter() - self.start, 1e-9)
+
+
+class Broadcaster:
+    def __init__(self, keyframe_interval=300, max_queue=64 * 1024):
+        self.keyframe_interval = keyframe_interval
+        self.max_queue = max_queue
+        self.game = None
+        self.subscribers = []
+        self.out = []
+        self.ticks = 0
+        self.keyframe_due = False
+        # what subscribers were last told, see flush()
+        self.sent_piece = None
+        self.sent_score = None
+        self.sent_gameover = False
+
+    def attach(self, game):
+        # follow game from now on, a new game starts with a keyframe
+        if self.game is not None:
+            self.game.listeners.remove(self.on_event)
+        self.game = game
+        game.listeners.append(self.on_event)
+        self.keyframe_due = True
+
+    def subscribe(self, writer):
+        # the caller runs the returned subscriber's run()
+        sub = Subscriber(writer, self.max_queue)
+        self.subscribers.append(sub)
+        return sub
+
+    def close(self):
+        if self.game is not None:
+            self.game.listeners.remove(self.on_event)
+            self.game = None
+        for sub in self.subscribers:
+            sub.close()
+        self.subscribers = []
+
+    def on_event(self, event, *args):
+        game = self.game
+        if event == "lock":
+            self.sync_piece()
+            self.out.append(LOCK)
+        elif event == "clear":
+            rows = args[0]
+            self.out.append(CLEAR.pack(b"C", len(rows)) + b"".join(ROW.pack(j) for j in rows))
+        elif event == "spawn":
+            self.out.append(SPAWN.pack(b"N", core.piece_code(game.piece), core.piece_code(game.next_piece),
+                                       game.x, game.y))
+            self.sent_piece = (game.piece, game.x, game.y)
+        elif event == "restore":
+            self.keyframe_due = True
+
+    def sync_piece(self):
+        game = self.game
+        if (game.piece, game.x, game.y) != self.sent_piece:
+            self.out.append(MOVE.pack(b"M", core.piece_code(game.piece), game.x, game.y))
+            self.sent_piece = (game.piece, game.x, game.y)
+
+    def keyframe(self):
+        game = self.game
+        self.sent_piece = (game.piece, game.x, game.y)
+        self.sent_score = (game.score, game.lines, game.level)
+        self.sent_gameover = game.gamestate is core.GameCore.GAMEOVER
+        data = game.snapshot()
+        return KEYFRAME.pack(b"K", len(data)) + data
+
+    def flush(self):
+        # once per tick, after the game stepped: this tick's messages go out
+        # as one chunk
+        game = self.game
+        if game is None:
+            return
+        self.ticks += 1
+        if self.keyframe_due or self.ticks % self.keyframe_interval == 0:
+            # supersedes everything before it
+            self.keyframe_due = False
+            self.out.clear()
+            keyframe = self.keyframe()
+            chunk = keyframe
+        else:
+            self.sync_piece()
+            if (game.score, game.lines, game.level) != self.sent_score:
+                self.sent_score = (game.score, game.lines, game.level)
+                self.out.append(SCORE.pack(b"S", *self.sent_score))
+            if game.gamestate is core.GameCore.GAMEOVER and not self.sent_gameover:
+                self.sent_gameover = True
+                self.out.append(GAMEOVER)
+            keyframe = None
+            chunk = b"".join(self.out)
+            self.out.clear()
+
+        for sub in self.subscribers:
+            if not sub.needs_keyframe and (not chunk or sub.send(chunk)):
+                continue
+            if keyframe is None:
+                # built once per tick for everyone who needs it
+                keyframe = self.keyframe()
+            sub.needs_keyframe = not sub.send(keyframe)
+        self.subscribers = [sub for sub in self.subscribers if not sub.closed]
+
+    def stats(self):
+        return [{"bytes_sent": sub.bytes_sent,
+                 "bytes_per_second": sub.bytes_per_second(),
+                 "dropped": sub.dropped} for sub in self.subscribers]
+
+
+class Spectator:
+    # the viewer's side: feed it the stream, game is the copy it keeps up to
+    # date, None until the first keyframe arrived
+    def __init__(self):
+        self.game = None
+        self.buffer = b""
+
+    def feed(self, data):
+        buf = self.buffer + data
+        i = 0
+        while i < len(buf):
+            n = self.apply(buf, i)
+            if n is None:
+                break
+            i += n
+        self.buffer = buf[i:]
+
+    def apply(self, buf, i):
+        # bytes used by the message at buf[i], None if it is not complete
+        kind = buf[i:i + 1]
+        if kind == b"K":
+            if len(buf) < i + KEYFRAME.size:
+                return None
+            _, length = KEYFRAME.unpack_from(buf, i)
+            if len(buf) < i + KEYFRAME.size + length:
+                return None
+            self.game = core.GameCore.from_snapshot(buf[i + KEYFRAME.size:i + KEYFRAME.size + length])
+            return KEYFRAME.size + length
+        if kind == b"C":
+            if len(buf) < i + CLEAR.size:
+                return None
+            size = CLEAR.size + buf[i + 1] * ROW.size
+        else:
+            size = {b"M": MOVE.size, b"S": SCORE.size, b"N": SPAWN.size, LOCK: 1, GAMEOVER: 1}.get(kind)
+            if size is None:
+                raise Exception("Unknown spectator message: ", kind)
+        if len(buf) < i + size:
+            return None
+
+        game = self.game
+        if game is None:
+            # joined between keyframes
+            return size
+        if kind == b"M":
+            _, piece, game.x, game.y = MOVE.unpack_from(buf, i)
+            game.piece = core.code_piece(piece)
+        elif kind == LOCK:
+            game.board.put(game.piece, game.x, game.y)
+        elif kind == b"C":
+            game.board.clear_rows([ROW.unpack_from(buf, i + CLEAR.size + 2 * n)[0] for n in range(buf[i + 1])])
+        elif kind == b"S":
+            _, game.score, game.lines, game.level = SCORE.unpack_from(buf, i)
+        elif kind == b"N":
+            _, piece, next_piece, game.x, game.y = SPAWN.unpack_from(buf, i)
+            game.piece, game.next_piece = core.code_piece(piece), core.code_piece(next_piece)
+        elif kind == GAMEOVER:
+            game.gamestate = core.GameCore.GAMEOVER
+        game.dirty = True
+        return size
+
+
+async def watch(host, port, session=""):
+    # draws the game of a server.py session in this terminal
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write("{}\n".format(session).encode())
+    spectator = Spectator()
+    screen = None
+    sys.stdout.write("\x1b[2J\x1b[?25l")
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            spectator.feed(data)
+            game = spectator.game
+            if game is None or not game.dirty:
+                continue
+            if screen is None or (screen.width, screen.height) != (game.board_width + 16, game.board_height + 3):
+                screen = ansi.AnsiScreen(sys.stdout.write, game.board_width + 16, game.board_height + 3)
+            ansi.draw_game(screen, game)
+            screen.flush()
+            sys.stdout.flush()
+            game.dirty = False
+    finally:
+        sys.stdout.write("\x1b[0m\x1b[?25h\n")
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch a game on a server.py server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7778, help="the server's spectator port")
+    parser.add_argument("session", nargs="?", default="", help="session number, default the newest game")
+    args = parser.parse_args()
+    try:
+        asyncio.run(watch(args.host, args.port, args.session))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
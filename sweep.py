@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import statistics
+import time
+import bot
+import core
+import tetromino
+
+
+# Parameter sweeps of bot games. The grid is a JSON object of GameCore
+# parameter name -> list of values, every combination is played on every
+# seed. Each finished game is appended to the output as one JSON line, so
+# an interrupted sweep resumes by skipping the games already in there.
+# scoring is given as the points for clearing 1, 2, 3 and 4 rows.
+
+PARAMS = ("gravity_interval", "lock_interval", "lines_per_level", "scoring", "kick_sign")
+
+
+def configs(grid):
+    for name in grid:
+        if name not in PARAMS:
+            raise Exception("Unknown parameter: ", name)
+    if any(len(scoring) != 4 for scoring in grid.get("scoring", [])):
+        raise Exception("scoring needs the points for 1 to 4 rows")
+    if any(sign not in tetromino.KICK_SIGNS for sign in grid.get("kick_sign", [])):
+        raise Exception("kick_sign is one of: ", tetromino.KICK_SIGNS)
+    names = sorted(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def job_key(params, seed):
+    return json.dumps(params, sort_keys=True), seed
+
+
+def play_game(params, seed, lookahead=False, max_pieces=None, realtime=True):
+    # runs in a worker process
+    start = time.perf_counter()
+    game = core.GameCore(seed=seed)
+    for name, value in params.items():
+        setattr(game, name, (0, *value) if name == "scoring" else value)
+    player = bot.Bot(lookahead=lookahead)
+    bot.play(game, player, max_pieces, realtime)
+    return {"params": params, "seed": seed,
+            "score": game.score, "lines": game.lines, "level": game.level,
+            "pieces": player.pieces, "ticks": game.tick,
+            "gameover": game.gamestate is core.GameCore.GAMEOVER,
+            "seconds": time.perf_counter() - start}
+
+
+def load_results(filename):
+    # finished games in the output file, a line cut short by an interruption
+    # is skipped
+    try:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
+
+def run(grid, seeds, filename, workers=None, lookahead=False, max_pieces=None, realtime=True):
+    # plays the games missing from filename, returns how many were played
+    done = {job_key(r["params"], r["seed"]) for r in load_results(filename)}
+    jobs = ((params, seed) for params in configs(grid) for seed in seeds
+            if job_key(params, seed) not in done)
+
+    played = 0
+    cut_short = False
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        with open(filename, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            cut_short = f.read(1) != b"\n"
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "a") as out:
+        if cut_short:
+            out.write("\n")
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            # a few games per worker in flight, so memory does not grow with
+            # the size of the sweep
+            window = 4 * workers
+            pending = {pool.submit(play_game, params, seed, lookahead, max_pieces, realtime)
+                       for params, seed in itertools.islice(jobs, window)}
+            try:
+                while pending:
+                    finished, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in finished:
+                        out.write(json.dumps(f.result()) + "\n")
+                        played += 1
+                    out.flush()
+                    for params, seed in itertools.islice(jobs, len(finished)):
+                        pending.add(pool.submit(play_game, params, seed, lookahead, max_pieces, realtime))
+            except KeyboardInterrupt:
+                pool.shutdown(cancel_futures=True)
+                raise
+    return played
+
+
+def summarize(results):
+    # per parameter combination: number of games and statistics of the
+    # results, best mean score first
+    groups = {}
+    for r in results:
+        groups.setdefault(json.dumps(r["params"], sort_keys=True), []).append(r)
+    summary = []
+    for key, games in groups.items():
+        entry = {"params": json.loads(key), "games": len(games)}
+        for name in ("score", "lines", "pieces"):
+            values = [g[name] for g in games]
+            entry[name] = {"mean": statistics.fmean(values),
+                           "median": statistics.median(values),
+                           "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+                           "min": min(values),
+                           "max": max(values)}
+        entry["gameover_rate"] = sum(g["gameover"] for g in games) / len(games)
+        summary.append(entry)
+    summary.sort(key=lambda e: e["score"]["mean"], reverse=True)
+    return summary
+
+
+def seed_range(text):
+    # "100" is seeds 0 to 99, "100:200" seeds 100 to 199
+    start, _, stop = text.rpartition(":")
+    return range(int(start) if start else 0, int(stop))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep game parameters with bot games on all cores.")
+    parser.add_argument("grid", help="JSON file: parameter -> list of values, parameters are " + ", ".join(PARAMS))
+    parser.add_argument("--seeds", type=seed_range, default=seed_range("10"),
+                        help="N for seeds 0..N-1 or START:STOP, default 10")
+    parser.add_argument("--out", required=True, help="JSON lines of finished games, appended to and resumed from")
+    parser.add_argument("--summary", help="write the summary as JSON to this file")
+    parser.add_argument("--workers", type=int, default=None, help="default one per core")
+    parser.add_argument("--max-pieces", type=int, default=1000)
+    parser.add_argument("--lookahead", action="store_true", help="slower, stronger bot")
+    parser.add_argument("--instant", action="store_true",
+                        help="place each piece in one tick, faster but gravity and lock delay have no effect")
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    start = time.perf_counter()
+    played = run(grid, args.seeds, args.out, args.workers, args.lookahead, args.max_pieces,
+                 not args.instant)
+    print("{} games played in {:.1f}s".format(played, time.perf_counter() - start))
+
+    # only the combinations of this grid, the file may hold other sweeps
+    wanted = {json.dumps(params, sort_keys=True) for params in configs(grid)}
+    seeds = set(args.seeds)
+    results = [r for r in load_results(args.out)
+               if json.dumps(r["params"], sort_keys=True) in wanted and r["seed"] in seeds]
+    summary = summarize(results)
+    for entry in summary:
+        print("{:60} {:4} games  score {:10.1f} +- {:8.1f}  lines {:8.1f}  game over {:4.0%}".format(
+            json.dumps(entry["params"], sort_keys=True), entry["games"],
+            entry["score"]["mean"], entry["score"]["stdev"], entry["lines"]["mean"],
+            entry["gameover_rate"]))
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import random
+import tetromino
+
+
+# Bitboard and SparseBitboard against the reference check_collision and
+# check_in_board, on random boards for every piece state and positions
+# around and outside the board. The reference indexes the board directly,
+# so collisions are only compared where the piece is inside the board.
+
+def random_board(rng, num_rows, num_cols):
+    board = tetromino.make_board(num_rows, num_cols)
+    # a random stack height, denser towards the bottom
+    stack = rng.randrange(num_rows + 1)
+    for j in range(num_rows - stack, num_rows):
+        for i in range(num_cols):
+            if rng.random() < 0.6:
+                board[j][i] = rng.choice(tetromino.PIECE_NAMES)
+    return board
+
+
+def compare(board, bitboard, rng, positions=50):
+    num_rows, num_cols = tetromino.height(board), tetromino.width(board)
+    cases = 0
+    for rotations in tetromino.PIECE_STATES.values():
+        for t in rotations:
+            for _ in range(positions):
+                x = rng.randrange(-4, num_cols + 2)
+                y = rng.randrange(-4, num_rows + 2)
+                expected = tetromino.check_in_board(board, t, x, y)
+                assert bitboard.check_in_board(t, x, y) == expected, (t.name, t.which, x, y)
+                if expected is None:
+                    assert bitboard.check_collision(t, x, y) == tetromino.check_collision(board, t, x, y), \
+                        (t.name, t.which, x, y)
+                cases += 1
+    return cases
+
+
+def test_bitboard_matches_reference():
+    rng = random.Random(1)
+    cases = 0
+    for _ in range(40):
+        board = random_board(rng, rng.randrange(4, 25), rng.randrange(4, 13))
+        cases += compare(board, tetromino.Bitboard.from_board(board), rng)
+    assert cases > 3000
+
+
+def test_sparse_bitboard_matches_reference():
+    rng = random.Random(2)
+    cases = 0
+    for _ in range(40):
+        board = random_board(rng, rng.randrange(4, 25), rng.randrange(4, 13))
+        cases += compare(board, tetromino.SparseBitboard.from_board(board), rng)
+    assert cases > 3000
+
+
+def test_every_position_on_one_board():
+    # exhaustive on a small board, including the first positions outside it
+    rng = random.Random(3)
+    board = random_board(rng, 8, 6)
+    for cls in (tetromino.Bitboard, tetromino.SparseBitboard):
+        bitboard = cls.from_board(board)
+        for rotations in tetromino.PIECE_STATES.values():
+            for t in rotations:
+                for x in range(-4, 8):
+                    for y in range(-4, 10):
+                        expected = tetromino.check_in_board(board, t, x, y)
+                        assert bitboard.check_in_board(t, x, y) == expected, (cls, t.name, t.which, x, y)
+                        if expected is None:
+                            assert bitboard.check_collision(t, x, y) == \
+                                tetromino.check_collision(board, t, x, y), (cls, t.name, t.which, x, y)
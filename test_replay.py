@@ -0,0 +1,56 @@
+import random
+import core
+import replay
+
+
+# Play random keys through the core while recording them, then replay the
+# log headless and compare the final games. A hard drop now and then keeps
+# the games short; they are played until game over.
+
+def play(filename, seed, immediate_input):
+    rng = random.Random(seed)
+    game = core.GameCore(seed=seed)
+    recorder = replay.Recorder(filename, game, immediate_input)
+    keys = sorted(core.KEYMAP)
+    while game.gamestate is not core.GameCore.GAMEOVER:
+        actions = []
+        for _ in range(rng.choice((0, 0, 0, 1, 2))):
+            key = rng.choice(keys)
+            recorder.record(game.tick, key)
+            actions.append(core.KEYMAP[key])
+        if immediate_input:
+            game.step(actions, 0)
+            actions = []
+            if game.gamestate is core.GameCore.GAMEOVER:
+                break
+        game.step(actions)
+    recorder.finish(game)
+    return game
+
+
+def check_round_trip(tmp_path, immediate_input):
+    for seed in range(5):
+        filename = str(tmp_path / "game{}.log".format(seed))
+        game = play(filename, seed, immediate_input)
+        log = replay.InputLog.load(filename)
+        result = replay.replay(log)
+        assert result.gamestate is core.GameCore.GAMEOVER
+        assert (result.tick, result.score, result.lines, result.level) == \
+            (game.tick, game.score, game.lines, game.level)
+        assert result.board.to_bytes() == game.board.to_bytes()
+
+
+def test_round_trip(tmp_path):
+    check_round_trip(tmp_path, False)
+
+
+def test_round_trip_immediate_input(tmp_path):
+    check_round_trip(tmp_path, True)
+
+
+def test_recorder_creates_directory(tmp_path):
+    filename = str(tmp_path / "logs" / "new" / "game.log")
+    game = core.GameCore(seed=1)
+    recorder = replay.Recorder(filename, game)
+    recorder.finish(game)
+    assert replay.InputLog.load(filename).end["end"] == 0
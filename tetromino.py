@@ -21,7 +21,18 @@ def width(array2d):
     return len(array2d[0])
 
 
+# (rotations, kicks) by (pattern, N), so each table is built once and shared
+# by everything asking for the same piece. kicks holds the kick order for
+# both kick signs, -1 tries left and up first, 1 right and down.
+SHAPE_TEMPLATES = {}
+KICK_SIGNS = (-1, 1)
+
+
 def make_shape_template(p, N=4):
+    key = (tuple(p), N)
+    if key in SHAPE_TEMPLATES:
+        return SHAPE_TEMPLATES[key]
+
     def kicks_1d(n, sign=-1):
         yield 0
         for i in range(1, n):
@@ -30,16 +41,19 @@ def make_shape_template(p, N=4):
 
     assert(height(p) == width(p))
     
-    r = [p]
+    r = [tuple(p)]
     for _ in range(N - 1):
-        p = list(zip(*(p[::-1])))
+        p = tuple(zip(*(p[::-1])))
         r.append(p)
     
     n = height(p) - 1
     
-    kicks = [(dx, dy) for dy in kicks_1d(n) for dx in kicks_1d(n)]
+    kicks = {sign: tuple((dx, dy) for dy in kicks_1d(n, sign) for dx in kicks_1d(n, sign))
+             for sign in KICK_SIGNS}
             
-    return r, kicks
+    # shared between callers, nothing in it may be changed
+    SHAPE_TEMPLATES[key] = tuple(r), kicks
+    return SHAPE_TEMPLATES[key]
     
 
     
@@ -89,6 +103,14 @@ class Tetromino:
     def width(self):
         return width(self.shape())
 
+    @property
+    def rows(self):
+        return piece_state(self.name, self.which).rows
+
+    @property
+    def bottom(self):
+        return piece_state(self.name, self.which).bottom
+
     
 
 def check_collision(board, t, x, y):
@@ -114,3 +136,419 @@ def check_in_board(board, t, x, y):
                     return "bottom"
     return None
 
+
+# bitboard engine: every board row is an int with bit i set when column i is
+# occupied, pieces are precomputed per rotation as row bitmasks. The functions
+# above are kept as the reference implementation.
+
+class PieceState:
+    # immutable, one instance per (name, rotation), all created at import.
+    # rows holds (j, bits, lo, hi) for each non-empty row of the shape, bits
+    # are shifted so that bit 0 is the leftmost block at column lo
+    __slots__ = ("name", "which", "rotations", "template", "cells", "rows",
+                 "bottom", "bbox", "kicks", "size")
+
+    def __init__(self, name, which, template, kicks):
+        cells = tuple((i, j) for j, line in enumerate(template)
+                             for i, c in enumerate(line) if is_block(c))
+        rows = []
+        for j, line in enumerate(template):
+            cols = [i for i, c in enumerate(line) if is_block(c)]
+            if cols:
+                lo, hi = cols[0], cols[-1]
+                bits = 0
+                for i in cols:
+                    bits |= 1 << (i - lo)
+                rows.append((j, bits, lo, hi))
+        set_ = super().__setattr__
+        set_("name", name)
+        set_("which", which)
+        set_("rotations", None)
+        set_("template", template)
+        set_("cells", cells)
+        set_("rows", tuple(rows))
+        # lowest block per column, (i, j), used to find the landing row
+        set_("bottom", tuple(sorted({i: max(jj for ii, jj in cells if ii == i)
+                                     for i, _ in cells}.items())))
+        set_("bbox", (min(i for i, _ in cells), min(j for _, j in cells),
+                      max(i for i, _ in cells), max(j for _, j in cells)))
+        # kick order by kick sign, shared with the other rotations
+        set_("kicks", kicks)
+        set_("size", (width(template), height(template)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PieceState is immutable")
+
+    def __reduce__(self):
+        # pickled and copied by reference to the interned instance
+        return piece_state, (self.name, self.which)
+
+    def __repr__(self):
+        return "\n".join("".join(l) for l in self.template)
+
+    def shape(self):
+        return self.template
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+    def rotate(self, rot):
+        return self.rotations[(self.which + rot) % len(self.rotations)]
+
+
+def _make_piece_states():
+    states = {}
+    for name, (shapes, kicks) in Tetromino.available_templates.items():
+        rotations = tuple(PieceState(name, which, shape, kicks)
+                          for which, shape in enumerate(shapes))
+        for p in rotations:
+            object.__setattr__(p, "rotations", rotations)
+        states[name] = rotations
+    return states
+
+
+PIECE_STATES = _make_piece_states()
+PIECE_NAMES = tuple(PIECE_STATES.keys())
+CELL_CODES = {name: n + 1 for n, name in enumerate(PIECE_NAMES)}
+CELL_CODES[None] = 0
+
+
+def piece_state(name, which=0):
+    rotations = PIECE_STATES[name]
+    return rotations[which % len(rotations)]
+
+
+class Bitboard:
+    def __init__(self, num_rows, num_cols):
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.full_row = (1 << num_cols) - 1
+        self.rows = [0] * num_rows
+        # color plane, only used for rendering
+        self.colors = make_board(num_rows, num_cols)
+        # highest filled row in each column, num_rows when the column is empty
+        self.tops = [num_rows] * num_cols
+        # number of filled cells in each row
+        self.counts = [0] * num_rows
+        # a stamp per row, new whenever the row is written to, 0 for rows
+        # that never were. Renderers cache rows by it.
+        self.version = 0
+        self.versions = [0] * num_rows
+
+    @classmethod
+    def from_board(cls, board):
+        b = cls(height(board), width(board))
+        for j, row in enumerate(board):
+            for i, c in enumerate(row):
+                if is_block(c):
+                    b.rows[j] |= 1 << i
+                    b.colors[j][i] = c
+                    b.tops[i] = min(b.tops[i], j)
+                    b.counts[j] += 1
+            b.version += 1
+            b.versions[j] = b.version
+        return b
+
+    def copy(self):
+        b = Bitboard.__new__(Bitboard)
+        b.num_rows, b.num_cols, b.full_row = self.num_rows, self.num_cols, self.full_row
+        b.rows = self.rows[:]
+        b.colors = [row[:] for row in self.colors]
+        b.tops = self.tops[:]
+        b.counts = self.counts[:]
+        b.version = self.version
+        b.versions = self.versions[:]
+        return b
+
+    def to_bytes(self):
+        # the rows from the highest filled cell down, one byte per cell: 0
+        # empty, else 1 + index in PIECE_NAMES. The number of rows follows
+        # from the length.
+        top = min(self.tops)
+        code = CELL_CODES.__getitem__
+        return b"".join(bytes(map(code, row)) for row in self.colors[top:])
+
+    @classmethod
+    def from_bytes(cls, num_rows, num_cols, data):
+        b = cls(num_rows, num_cols)
+        first = num_rows - len(data) // num_cols
+        for n in range(len(data) // num_cols):
+            cells = data[n * num_cols:(n + 1) * num_cols]
+            if cells.count(0) < num_cols:
+                b.set_row(first + n, [PIECE_NAMES[code - 1] if code else None for code in cells])
+        return b
+
+    def set_row(self, j, colors):
+        # only for building boards, the row must be empty before
+        row = 0
+        for i, c in enumerate(colors):
+            if c is not None:
+                row |= 1 << i
+                if j < self.tops[i]:
+                    self.tops[i] = j
+        self.rows[j] = row
+        self.colors[j] = colors
+        self.counts[j] = bin(row).count("1")
+        self.version += 1
+        self.versions[j] = self.version
+
+    def row_count(self, j):
+        return self.counts[j]
+
+    def row_colors(self, j):
+        return self.colors[j]
+
+    def row_version(self, j):
+        return self.versions[j]
+
+    def check_collision(self, t, x, y):
+        rows = self.rows
+        for j, bits, lo, hi in t.rows:
+            if rows[y + j] & (bits << (x + lo)):
+                return x, y
+        return None
+
+    def check_in_board(self, t, x, y):
+        # same answers, in the same order, as check_in_board()
+        h, w = self.num_rows, self.num_cols
+        for j, bits, lo, hi in t.rows:
+            if x + lo < 0:
+                return "left"
+            if y + j < 0 or y + j >= h:
+                if x + lo >= w:
+                    return "right"
+                return "top" if y + j < 0 else "bottom"
+            if x + hi >= w:
+                return "right"
+        return None
+
+    def put(self, t, x, y):
+        # returns the rows the piece was put into
+        touched = []
+        for j, bits, lo, hi in t.rows:
+            if 0 <= y + j < self.num_rows:
+                added = (bits << (x + lo)) & self.full_row & ~self.rows[y + j]
+                self.rows[y + j] |= added
+                self.counts[y + j] += bin(added).count("1")
+                self.version += 1
+                self.versions[y + j] = self.version
+                touched.append(y + j)
+        for i, j in piece_state(t.name, t.which).cells:
+            if 0 <= y + j < self.num_rows and 0 <= x + i < self.num_cols:
+                self.colors[y + j][x + i] = t.name
+                if y + j < self.tops[x + i]:
+                    self.tops[x + i] = y + j
+        return touched
+
+    def landing_row(self, t, x, y):
+        # lowest y the piece can fall to from (x, y), taken straight from the
+        # column heights. None when a column is filled above the piece (it
+        # sits under an overhang), then the caller has to probe row by row.
+        land = self.num_rows
+        tops = self.tops
+        for i, j in t.bottom:
+            top = tops[x + i]
+            if top <= y + j:
+                return None
+            if top - j - 1 < land:
+                land = top - j - 1
+        return land
+
+    def row_full(self, j):
+        return self.counts[j] == self.num_cols
+
+    def clear_rows(self, candidates=None):
+        # only the candidate rows (all of them by default) are checked, the
+        # board is compacted in place and the cleared rows' lists are reused
+        if candidates is None:
+            candidates = range(self.num_rows)
+        full = [j for j in candidates if self.counts[j] == self.num_cols]
+        if not full:
+            return 0
+
+        rows, colors, counts = self.rows, self.colors, self.counts
+        stack_top = min(self.tops)
+        free = [colors[j] for j in full]
+        full = set(full)
+        dst = max(full)
+        for src in range(dst, stack_top - 1, -1):
+            if src not in full:
+                rows[dst], colors[dst], counts[dst] = rows[src], colors[src], counts[src]
+                dst -= 1
+        for j in range(stack_top, dst + 1):
+            row = free.pop()
+            row[:] = [None] * self.num_cols
+            rows[j], colors[j], counts[j] = 0, row, 0
+        # every row down to the lowest cleared one has new contents
+        self.version += 1
+        for j in range(stack_top, max(full) + 1):
+            self.versions[j] = self.version
+
+        # rows only move down, so each new top is at or below the old one
+        for i, top in enumerate(self.tops):
+            bit = 1 << i
+            while top < self.num_rows and not rows[top] & bit:
+                top += 1
+            self.tops[i] = top
+        return len(full)
+
+
+
+class SparseBitboard(Bitboard):
+    # for boards much larger than the stack on them. Only the rows from the
+    # bottom up to the highest filled cell are stored, bottom row first, so
+    # memory and the work per move follow the stack and the piece instead of
+    # the board size. Row numbers in the interface count from the top, as
+    # in Bitboard.
+    def __init__(self, num_rows, num_cols):
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.full_row = (1 << num_cols) - 1
+        self.stack = []
+        self.stack_colors = []
+        self.stack_counts = []
+        self.stack_versions = []
+        self.version = 0
+        self.tops = [num_rows] * num_cols
+        self.empty_colors = [None] * num_cols
+
+    @classmethod
+    def from_board(cls, board):
+        b = cls(height(board), width(board))
+        for j, row in enumerate(board):
+            if any(is_block(c) for c in row):
+                b.set_row(j, [c if is_block(c) else None for c in row])
+        return b
+
+    def copy(self):
+        b = SparseBitboard.__new__(SparseBitboard)
+        b.num_rows, b.num_cols, b.full_row = self.num_rows, self.num_cols, self.full_row
+        b.stack = self.stack[:]
+        b.stack_colors = [row[:] for row in self.stack_colors]
+        b.stack_counts = self.stack_counts[:]
+        b.stack_versions = self.stack_versions[:]
+        b.version = self.version
+        b.tops = self.tops[:]
+        b.empty_colors = self.empty_colors
+        return b
+
+    def _grow(self, k):
+        # store rows up to stack index k
+        while len(self.stack) <= k:
+            self.stack.append(0)
+            self.stack_colors.append([None] * self.num_cols)
+            self.stack_counts.append(0)
+            self.stack_versions.append(0)
+
+    # the full planes, built on demand for code written against Bitboard
+    @property
+    def rows(self):
+        return [self.row_bits(j) for j in range(self.num_rows)]
+
+    @property
+    def colors(self):
+        return [self.row_colors(j)[:] for j in range(self.num_rows)]
+
+    @property
+    def counts(self):
+        return [self.row_count(j) for j in range(self.num_rows)]
+
+    def row_bits(self, j):
+        k = self.num_rows - 1 - j
+        return self.stack[k] if 0 <= k < len(self.stack) else 0
+
+    def row_count(self, j):
+        k = self.num_rows - 1 - j
+        return self.stack_counts[k] if 0 <= k < len(self.stack) else 0
+
+    def row_colors(self, j):
+        k = self.num_rows - 1 - j
+        return self.stack_colors[k] if 0 <= k < len(self.stack) else self.empty_colors
+
+    def row_version(self, j):
+        # rows above the stack are empty, and were before or got a new
+        # stamp when they left the stack
+        k = self.num_rows - 1 - j
+        return self.stack_versions[k] if 0 <= k < len(self.stack) else 0
+
+    def set_row(self, j, colors):
+        self._grow(self.num_rows - 1 - j)
+        k = self.num_rows - 1 - j
+        row = 0
+        for i, c in enumerate(colors):
+            if c is not None:
+                row |= 1 << i
+                if j < self.tops[i]:
+                    self.tops[i] = j
+        self.stack[k] = row
+        self.stack_colors[k] = colors
+        self.stack_counts[k] = bin(row).count("1")
+        self.version += 1
+        self.stack_versions[k] = self.version
+
+    def to_bytes(self):
+        code = CELL_CODES.__getitem__
+        return b"".join(bytes(map(code, row)) for row in reversed(self.stack_colors))
+
+    def check_collision(self, t, x, y):
+        stack = self.stack
+        n = len(stack)
+        base = self.num_rows - 1 - y
+        for j, bits, lo, hi in t.rows:
+            k = base - j
+            if 0 <= k < n and stack[k] & (bits << (x + lo)):
+                return x, y
+        return None
+
+    def put(self, t, x, y):
+        touched = []
+        base = self.num_rows - 1 - y
+        for j, bits, lo, hi in t.rows:
+            if 0 <= y + j < self.num_rows:
+                k = base - j
+                self._grow(k)
+                added = (bits << (x + lo)) & self.full_row & ~self.stack[k]
+                self.stack[k] |= added
+                self.stack_counts[k] += bin(added).count("1")
+                self.version += 1
+                self.stack_versions[k] = self.version
+                touched.append(y + j)
+        for i, j in piece_state(t.name, t.which).cells:
+            if 0 <= y + j < self.num_rows and 0 <= x + i < self.num_cols:
+                self.stack_colors[base - j][x + i] = t.name
+                if y + j < self.tops[x + i]:
+                    self.tops[x + i] = y + j
+        return touched
+
+    def row_full(self, j):
+        return self.row_count(j) == self.num_cols
+
+    def clear_rows(self, candidates=None):
+        if candidates is None:
+            candidates = range(self.num_rows - len(self.stack), self.num_rows)
+        full = sorted({self.num_rows - 1 - j for j in candidates if self.row_count(j) == self.num_cols},
+                      reverse=True)
+        if not full:
+            return 0
+
+        # the rows above drop by deleting the full ones
+        for k in full:
+            del self.stack[k], self.stack_colors[k], self.stack_counts[k], self.stack_versions[k]
+        while self.stack and not self.stack[-1]:
+            self.stack.pop()
+            self.stack_colors.pop()
+            self.stack_counts.pop()
+            self.stack_versions.pop()
+        self.version += 1
+        for k in range(full[-1], len(self.stack)):
+            self.stack_versions[k] = self.version
+
+        for i, top in enumerate(self.tops):
+            bit = 1 << i
+            while top < self.num_rows and not self.row_bits(top) & bit:
+                top += 1
+            self.tops[i] = top
+        return len(full)